@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the color conversions done for every command and status report, comparing the per-call
+arithmetic they used to do with the lookup tables and memoized conversions in magichome.py.
+
+Each conversion is first checked to give exactly the same values as the per-call code, then timed for a
+group of LEDs at different brightnesses, as a group or scene command would convert them.
+
+Example:
+    python3 bench/bench_colors.py -n 200 -r 500
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR) #Use the polyinterface stand-in
+sys.path.insert(1, ROOT_DIR)
+os.chdir(ROOT_DIR) #magichome.py reads server.json from the working directory
+
+import magichome
+
+
+#The per-call conversions, as the node server did them before
+def oldNamedColor(color, brightness):
+    _pct_brightness = brightness / 100. if brightness > 0 else 1
+    return tuple(int(c * _pct_brightness) for c in magichome.COLORS[color][1])
+
+
+def oldScaleColor(color, level):
+    _max = max(color)
+    return tuple(int(_c / _max * 255. * level / 100.) for _c in color)
+
+
+def oldBrightness(red, green, blue, white, white2):
+    return math.ceil(max(red, green, blue, white, white2) / 255. * 100.)
+
+
+def oldTemperatureWhites(kelvin, brightness):
+    #flux_led's setWhiteTemperature
+    t = max(kelvin - 2700, 0)
+    warm = 255 * (1 - (t / 3800))
+    cold = min(255 * t / 3800, 255)
+    warm *= brightness / 255
+    cold *= brightness / 255
+    return warm, cold
+
+
+def group(count):
+    #Brightness (0-100 and 0-255) and last color of each LED in a group
+    _colors = [(i * 37 % 256, i * 91 % 256, i * 13 % 255 + 1, i % 256, 0) for i in range(count)]
+    return [i % 101 for i in range(count)], [i * 7 % 256 for i in range(count)], _colors
+
+
+def verify(count):
+    _levels, _values, _colors = group(count)
+    for _color in range(len(magichome.COLORS)):
+        assert magichome.namedColors(_color, _levels) == [oldNamedColor(_color, b) for b in _levels]
+    for _level in range(101):
+        assert magichome.scaleColors(_colors, _level) == [oldScaleColor(c, _level) for c in _colors]
+        assert [magichome.scaleColor(c, _level) for c in _colors] == [oldScaleColor(c, _level) for c in _colors]
+    for _color in _colors + [(v, 0, 0, 0, 0) for v in range(256)] + [(254.5, 0, 0, 0, 0)]:
+        assert magichome.brightnessOf(*_color) == oldBrightness(*_color)
+    for _kelvin in range(magichome.KELVIN_MIN, magichome.KELVIN_MAX + 1):
+        assert magichome.temperatureColors(_kelvin, _values) == [oldTemperatureWhites(_kelvin, b) for b in _values]
+
+
+def run(func, rounds):
+    _start = time.process_time()
+    for i in range(rounds):
+        func(i)
+    return time.process_time() - _start
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='Measure the CPU cost of color conversions for a group of MagicHome LEDs')
+    _parser.add_argument('-n', '--bulbs', type=int, default=100, help='LEDs in the group')
+    _parser.add_argument('-r', '--rounds', type=int, default=1000, help='group commands per measurement')
+    _args = _parser.parse_args()
+
+    verify(_args.bulbs)
+    print('All conversions match the per-call code for {} LEDs'.format(_args.bulbs))
+
+    _levels, _values, _colors = group(_args.bulbs)
+    _span = magichome.KELVIN_MAX - magichome.KELVIN_MIN + 1
+    _cases = (
+        ('named color', lambda i: [oldNamedColor(i % len(magichome.COLORS), b) for b in _levels],
+                        lambda i: magichome.namedColors(i % len(magichome.COLORS), _levels)),
+        ('scale level', lambda i: [oldScaleColor(c, i % 101) for c in _colors],
+                        lambda i: magichome.scaleColors(_colors, i % 101)),
+        ('brightness', lambda i: [oldBrightness(*c) for c in _colors],
+                       lambda i: [magichome.brightnessOf(*c) for c in _colors]),
+        ('temperature', lambda i: [oldTemperatureWhites(magichome.KELVIN_MIN + i * 100 % _span, b) for b in _values],
+                        lambda i: magichome.temperatureColors(magichome.KELVIN_MIN + i * 100 % _span, _values))
+    )
+    _conversions = float(_args.bulbs * _args.rounds)
+    for _name, _old, _new in _cases:
+        run(_old, min(_args.rounds, 100)) #Warm up, filling the caches
+        run(_new, min(_args.rounds, 100))
+        _before, _after = run(_old, _args.rounds), run(_new, _args.rounds)
+        print('{:12} per call {:6.3f} us   tables {:6.3f} us   {:4.1f}x'.format(
+            _name, _before / _conversions * 1e6, _after / _conversions * 1e6, _before / _after))
+    print('Scale cache: {}'.format(magichome._fullColor.cache_info()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Benchmarks magichome.py against simulated LED controllers (see fakebulb.py), using the polyinterface
+stand-in from this directory instead of a live Polyglot and ISY.
+
+Reports:
+- poll cycle time of Controller.query over all LEDs
+- command latency, from a command reaching the node to its last write arriving at the LED controller, how
+  long the ISY command thread was blocked by the handler and how many TCP reads the LED controller needed
+  (--command picks the command; with --status, also the time until the status is queried after it)
+- driver report volume, messages that would have been sent to Polyglot per poll cycle and per command
+- fade throughput, frames per second streamed to the whole fleet by a fade of all LEDs at once
+- freshness of changes made outside the node server (MagicHome app, IR remote): how soon they show up in the
+  nodes while shortPoll runs as under Polyglot, and how many status queries that took.  Use --push to have the
+  simulated controllers push their changes and --param push_listen=true to listen for them.
+- with --param write_rate=N, how many writes waited for the per-LED rate limit and how many were superseded
+
+Example:
+    python3 bench/bench_magichome.py -n 50 --latency 0.02 --drop 0.05
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR) #Use the polyinterface stand-in
+sys.path.insert(1, ROOT_DIR)
+os.chdir(ROOT_DIR) #magichome.py reads server.json from the working directory
+
+import polyinterface
+import magichome
+from fakebulb import FakeFleet, VARIANTS
+
+
+def percentile(values, pct):
+    if not values: return float('nan')
+    _values = sorted(values)
+    return _values[min(int(len(_values) * pct / 100.), len(_values) - 1)]
+
+
+def summary(values, scale=1000.):
+    return 'p50 {:8.2f}  p95 {:8.2f}  max {:8.2f} ms'.format(percentile(values, 50) * scale, percentile(values, 95) * scale, max(values or [float('nan')]) * scale)
+
+
+def buildController(fleet, params):
+    poly = polyinterface.Interface(config={'customParams': params, 'nodes': [], 'notices': {}})
+    controller = magichome.Controller(poly)
+    controller._loadConfig()
+    magichome.loadFluxLed()
+    if magichome.WORKER_PROCESSES > 0: controller._startWorkers()
+    for i, bulb in enumerate(fleet.bulbs):
+        address = 'fake{:06d}'.format(i)
+        for attempt in range(5): #The simulated controllers may drop the initial probe
+            try:
+                device = controller._newBulb(address, bulb.host, port=bulb.port)
+                break
+            except magichome.DeviceOffline:
+                if attempt == 4: raise
+        controller.addNode(magichome.MagicHomeLED(controller, controller.address, address, 'fake {}'.format(i), device = device))
+    if magichome.PUSH_LISTEN: controller.pushListener.start()
+    return poly, controller
+
+
+def ledNodes(controller):
+    return [controller.nodes[a] for a in sorted(controller.nodes) if isinstance(controller.nodes[a], magichome.MagicHomeLED)]
+
+
+def benchPoll(poly, controller, cycles):
+    _durations = []
+    _sent = poly.sent
+    for i in range(cycles):
+        controller._poll(block=True) #query() returns before the cycle has finished
+        _durations.append(controller.lastPollDuration)
+    return _durations, (poly.sent - _sent) / float(cycles)
+
+
+def command(name, address):
+    #A command as the ISY sends it, and the number of writes it makes to the LED controller
+    _color = {'R.uom56': random.randint(1, 255), 'G.uom56': random.randint(0, 255), 'B.uom56': random.randint(0, 255)}
+    if name == 'DON': return {'address': address, 'cmd': 'DON', 'value': random.randint(1, 100)}, 2
+    if name == 'SET_RGBW': return {'address': address, 'cmd': 'SET_RGBW', 'query': dict(_color, **{'W.uom56': 0})}, 2
+    return {'address': address, 'cmd': 'SET_RGB', 'query': _color}, 1
+
+
+def benchCommands(poly, controller, fleet, commands, timeout, name='SET_RGB', status=False):
+    _latencies = []
+    _blocked = []
+    _statusLatencies = []
+    _lost = 0
+    _sent = poly.sent
+    _reads = sum(b.reads for b in fleet.bulbs)
+    _nodes = ledNodes(controller)
+    for i in range(commands):
+        _index = i % len(_nodes)
+        node, bulb = _nodes[_index], fleet.bulbs[_index]
+        _command, _expected = command(name, node.address)
+        _writes = len(bulb.writes)
+        _queries = bulb.queries
+        _start = time.time()
+        node.runCmd(_command)
+        _blocked.append(time.time() - _start)
+        if bulb.waitForWrites(_writes + _expected, timeout):
+            _latencies.append(bulb.writes[_writes + _expected - 1][0] - _start)
+        else:
+            _lost += 1
+        if status: #Wait for the status query that follows the command
+            _deadline = time.time() + magichome.UPDATE_DELAY + timeout
+            while bulb.queries == _queries and time.time() < _deadline: time.sleep(0.001)
+            if bulb.queries > _queries: _statusLatencies.append(time.time() - _start)
+    time.sleep(magichome.UPDATE_DELAY + 0.5) #Let the post-command status updates run
+    _reads = (sum(b.reads for b in fleet.bulbs) - _reads) / float(max(commands, 1))
+    return _latencies, _blocked, _lost, (poly.sent - _sent) / float(max(commands, 1)), _statusLatencies, _reads
+
+
+def benchFades(controller, fleet, duration):
+    _nodes = ledNodes(controller)
+    _writes = [len(b.writes) for b in fleet.bulbs]
+    _dropped = controller.transitions.framesDropped
+    _start = time.time()
+    for i, node in enumerate(_nodes):
+        node.runCmd({'address': node.address, 'cmd': 'FADE_RGBW', 'query': {'R.uom56': 255 if i % 2 else 0, 'G.uom56': 0, 'B.uom56': 0 if i % 2 else 255, 'W.uom56': 0, 'D.uom58': duration}})
+    time.sleep(duration)
+    while any(controller.transitions.running(n) for n in _nodes): time.sleep(0.01)
+    _elapsed = time.time() - _start
+    _frames = sum(len(b.writes) - w for b, w in zip(fleet.bulbs, _writes))
+    time.sleep(magichome.UPDATE_DELAY + 0.5) #Let the post-fade status updates run
+    return _frames, _elapsed, controller.transitions.framesDropped - _dropped
+
+
+def benchExternal(controller, fleet, window, shortPoll):
+    #Change every simulated controller at once from "outside", then watch the nodes for window seconds
+    _nodes = ledNodes(controller)
+    _queries = sum(b.queries for b in fleet.bulbs)
+    _targets = []
+    for bulb in fleet.bulbs:
+        _color = [random.randint(1, 255), random.randint(0, 255), random.randint(0, 255)]
+        _targets.append(_color)
+        bulb.remote(color=_color, on=True)
+    _start = time.time()
+    _seen = {}
+    _nextPoll = _start + shortPoll
+    while time.time() - _start < window and len(_seen) < len(_nodes):
+        if time.time() >= _nextPoll:
+            controller.shortPoll() #As Polyglot would every shortPoll seconds
+            _nextPoll += shortPoll
+        for i, node in enumerate(_nodes):
+            if i not in _seen and [node.red, node.green, node.blue] == _targets[i]:
+                _seen[i] = time.time() - _start
+        time.sleep(0.005)
+    return list(_seen.values()), len(_nodes) - len(_seen), sum(b.queries for b in fleet.bulbs) - _queries
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='Benchmark magichome.py against simulated MagicHome LED controllers')
+    _parser.add_argument('-n', '--bulbs', type=int, default=20, help='number of simulated LED controllers')
+    _parser.add_argument('--variant', choices=sorted(VARIANTS), action='append', help='controller variant(s), assigned round robin')
+    _parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every request by the simulated controllers')
+    _parser.add_argument('--drop', type=float, default=0., help='fraction of requests ignored by the simulated controllers')
+    _parser.add_argument('--cycles', type=int, default=5, help='poll cycles to run')
+    _parser.add_argument('--commands', type=int, default=100, help='commands to send')
+    _parser.add_argument('--command', choices=('SET_RGB', 'DON', 'SET_RGBW'), default='SET_RGB', help='command to send, DON and SET_RGBW write a color and turn the LED on')
+    _parser.add_argument('--status', action='store_true', help='wait for the status query after each command and report how long it took')
+    _parser.add_argument('--fade', type=float, default=2., help='seconds of the fade sent to all LEDs, 0 to skip')
+    _parser.add_argument('--push', action='store_true', help='simulated controllers push changes made from outside the node server')
+    _parser.add_argument('--external', type=float, default=10., help='seconds to watch for changes made from outside the node server, 0 to skip')
+    _parser.add_argument('--param', action='append', default=[], metavar='KEY=VALUE', help='custom parameter passed to the node server')
+    _parser.add_argument('-v', '--verbose', action='store_true')
+    _args = _parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if _args.verbose else logging.WARNING, format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+    _params = dict(p.split('=', 1) for p in _args.param)
+    _params.setdefault('poll_timeout', str(max(1., _args.latency * 20)))
+    _params.setdefault('discovery_cache', '')
+
+    fleet = FakeFleet(_args.bulbs, tuple(_args.variant or ['rgb', 'rgbw', 'rgbww']), _args.latency, _args.drop, _args.push)
+    try:
+        _start = time.time()
+        poly, controller = buildController(fleet, _params)
+        print('Setup: {} LEDs connected in {:.3f} sec'.format(_args.bulbs, time.time() - _start))
+        controller._poll(block=True) #Warm up, the first status query of each LED also detects its protocol
+
+        _durations, _reports = benchPoll(poly, controller, _args.cycles)
+        print('Poll cycle ({} cycles):      {}'.format(_args.cycles, summary(_durations)))
+        print('Driver reports per cycle:   {:.1f}'.format(_reports))
+
+        _latencies, _blocked, _lost, _reports, _status, _reads = benchCommands(poly, controller, fleet, _args.commands, max(2., _args.latency * 20), _args.command, _args.status)
+        print('{} to device ({} cmds): {}  ({} lost)'.format(_args.command, _args.commands, summary(_latencies), _lost))
+        print('Command thread blocked:     {}'.format(summary(_blocked)))
+        if _args.status: print('Command to status query:    {}'.format(summary(_status)))
+        print('Driver reports per command: {:.1f}'.format(_reports))
+        print('TCP reads per command:      {:.1f} (at the simulated controllers, status queries included)'.format(_reads))
+
+        if _args.fade > 0:
+            _frames, _elapsed, _dropped = benchFades(controller, fleet, _args.fade)
+            print('Fade ({:.1f} sec at {:.0f} fps):    {} frames in {:.2f} sec, {:.1f} frames/sec across the fleet ({:.1f} per LED), {} dropped'.format(
+                _args.fade, magichome.TRANSITION_FPS, _frames, _elapsed, _frames / _elapsed, _frames / _elapsed / len(fleet.bulbs), _dropped))
+        if _args.external > 0:
+            with open('server.json') as _file:
+                _shortPoll = float(json.load(_file)['shortPoll'])
+            _latencies, _missed, _queries = benchExternal(controller, fleet, _args.external, _shortPoll)
+            print('Outside changes seen:       {}  ({} not seen within {:.0f} sec, {} status queries)'.format(summary(_latencies), _missed, _args.external, _queries))
+
+        _nodes = controller.metrics.snapshot()
+        _slowest = sorted((n['ops']['query']['p95'], a) for a, n in _nodes.items() if 'query' in n['ops'])[-3:]
+        print('Slowest status queries (p95): {}'.format(', '.join('{} {:.1f} ms'.format(a, p * 1000.) for p, a in reversed(_slowest))))
+        _queues = [q for q in (n.device.writeQueueStats() for n in ledNodes(controller)) if q is not None]
+        if _queues:
+            print('Write rate limit:           max queue depth {}, {} writes waited {:.2f} sec in total, {} superseded by a newer color'.format(
+                max(q['maxDepth'] for q in _queues), sum(q['waited'] for q in _queues), sum(q['waitTime'] for q in _queues), sum(q['superseded'] for q in _queues)))
+        print('Simulated controllers saw {} writes, {} queries, {} dropped requests'.format(
+            sum(len(b.writes) for b in fleet.bulbs), sum(b.queries for b in fleet.bulbs), sum(b.dropped for b in fleet.bulbs)))
+    finally:
+        fleet.close()
+
+
+if __name__ == "__main__":
+    main()
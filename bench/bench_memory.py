@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Measures the memory used per LED node (MagicHomeLED plus its ManagedBulb) for fleets of different sizes,
+using the polyinterface stand-in from this directory.
+
+Devices are built from discovery cache information, as on a warm restart, so no connections are made and
+only the node server's own state is measured.
+
+Example:
+    python3 bench/bench_memory.py -n 10 -n 100 -n 1000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR) #Use the polyinterface stand-in
+sys.path.insert(1, ROOT_DIR)
+os.chdir(ROOT_DIR) #magichome.py reads server.json from the working directory
+
+import polyinterface
+import magichome
+
+INFO = {'protocol': 'LEDENET', 'rgbwcapable': True, 'rgbwprotocol': False}
+
+
+def buildNodes(controller, count):
+    _nodes = []
+    for i in range(count):
+        address = 'mem{:07d}'.format(i)
+        device = magichome.ManagedBulb('10.0.{}.{}'.format(i // 250, i % 250 + 1), info=INFO)
+        node = magichome.MagicHomeLED(controller, controller.address, address, 'bulb {}'.format(i), device = device)
+        node._recordWrite(i % 256, 255 - i % 256, 128, 0, 0) #Give each node some color state
+        controller.nodes[address] = node #Not added through addNode, which would start polling
+        _nodes.append(node)
+    return _nodes
+
+
+def measure(count):
+    poly = polyinterface.Interface(config={'customParams': {}, 'nodes': [], 'notices': {}})
+    controller = magichome.Controller(poly)
+    magichome.loadFluxLed() #Imported on first use, not part of what each node uses
+    gc.collect()
+    tracemalloc.start()
+    _before = tracemalloc.get_traced_memory()[0]
+    _nodes = buildNodes(controller, count)
+    gc.collect()
+    _after, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del _nodes
+    controller.nodes.clear()
+    return (_after - _before) / float(count), _peak - _before
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='Measure the memory used per MagicHome LED node')
+    _parser.add_argument('-n', '--bulbs', type=int, action='append', help='fleet size(s), default 10, 100 and 1000')
+    _args = _parser.parse_args()
+    for _count in _args.bulbs or [10, 100, 1000]:
+        _perNode, _peak = measure(_count)
+        print('{:6d} LEDs: {:8.0f} bytes per node, {:8.1f} KiB in total (peak {:.1f} KiB)'.format(_count, _perNode, _perNode * _count / 1024., _peak / 1024.))
+
+
+if __name__ == "__main__":
+    main()
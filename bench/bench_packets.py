@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the CPU cost of building and sending color and on/off commands, with flux_led building
+every packet (packet_cache False) and with the cached packets sent directly (packet_cache True).
+
+Packets are written to a socket that discards them, so only the node server's own work is measured.
+
+Example:
+    python3 bench/bench_packets.py -n 200000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR) #Use the polyinterface stand-in
+sys.path.insert(1, ROOT_DIR)
+os.chdir(ROOT_DIR) #magichome.py reads server.json from the working directory
+
+import magichome
+
+#Controller capabilities as stored in the discovery cache, for each protocol variant
+VARIANTS = {
+    'rgb': {'protocol': None, 'rgbwcapable': False, 'rgbwprotocol': False},
+    'rgbw': {'protocol': None, 'rgbwcapable': True, 'rgbwprotocol': False},
+    'rgbww': {'protocol': 'LEDENET', 'rgbwcapable': True, 'rgbwprotocol': False}
+}
+
+
+class NullSocket(object):
+    def __init__(self):
+        self.bytes = 0
+
+    def send(self, data):
+        self.bytes += len(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.bytes += len(data)
+
+
+def nullBulb(variant):
+    _bulb = magichome.ManagedBulb('127.0.0.1', info=VARIANTS[variant]) #Built from cached info, no connection is made
+    _bulb._socket = NullSocket()
+    _bulb.online = True
+    return _bulb
+
+
+def setColor(bulb, i):
+    #What the SET_COLOR handler sends: a named color at the current brightness
+    _red, _green, _blue = magichome.namedColor(i % len(magichome.COLORS), i % 101)
+    bulb.setRgb(_red, _green, _blue)
+
+
+def setWhites(bulb, i):
+    bulb.setRgbw(w=i % 256, w2=255 - i % 256)
+
+
+def power(bulb, i):
+    if i % 2: bulb.turnOn()
+    else: bulb.turnOff()
+
+
+def run(func, bulb, count):
+    _start = time.process_time()
+    for i in range(count):
+        func(bulb, i)
+    return (time.process_time() - _start) / count
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='Measure the CPU cost per command of building and sending MagicHome packets')
+    _parser.add_argument('-n', '--count', type=int, default=100000, help='commands per measurement')
+    _args = _parser.parse_args()
+
+    for _variant in sorted(VARIANTS):
+        for _name, _func in (('set color', setColor), ('set whites', setWhites), ('on/off', power)):
+            if _func is setWhites and not VARIANTS[_variant]['rgbwcapable']: continue
+            _bulb = nullBulb(_variant)
+            _results = []
+            for _cache in (False, True):
+                magichome.PACKET_CACHE = _cache
+                run(_func, _bulb, min(_args.count, 1000)) #Warm up
+                _results.append(run(_func, _bulb, _args.count))
+            print('{:6} {:11} flux_led {:7.2f} us   cached {:7.2f} us   {:4.1f}x'.format(
+                _variant, _name, _results[0] * 1e6, _results[1] * 1e6, _results[0] / _results[1]))
+    print('Packet cache: {}'.format(magichome.colorPacket.cache_info()))
+
+
+if __name__ == "__main__":
+    main()
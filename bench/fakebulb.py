@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Simulated MagicHome LED controllers for exercising magichome.py without real hardware.
+
+Each FakeBulb listens on its own TCP port on localhost and speaks the subset of the flux_led wire protocol
+used by the node server: status query (0x81), color/white writes (0x31 persistent, 0x41 temporary),
+preset patterns (0x61) and power on/off (0x71).  With push, changes made through remote() (standing in for the
+MagicHome app or an IR remote) are announced to all connections with an unsolicited status frame.  Latency, the share of requests that are silently dropped and the controller variant
+(RGB, RGBW or 5 channel RGBWW) are configurable.
+"""
+
+import random
+import socket
+import threading
+import time
+
+#Model byte reported in the status response, flux_led derives protocol and capabilities from it
+VARIANTS = {
+    'rgb': 0x06,   #RGB only, 7 byte color writes with a write mask
+    'rgbw': 0x44,  #RGBW, 7 byte color writes
+    'rgbww': 0x25  #RGB + warm white + cold white (LEDENET protocol), 8 byte color writes
+}
+
+
+class FakeBulb(object):
+    def __init__(self, variant='rgbw', latency=0., drop=0., port=0, host='127.0.0.1', push=False):
+        self.variant = variant
+        self.push = push #Send a status frame to all connections when changed through remote()
+        self.model = VARIANTS[variant]
+        self.latency = latency #Seconds to wait before handling each request
+        self.drop = drop #Fraction (0-1) of requests ignored, as if lost on the network
+        self.on = True
+        self.color = [0, 0, 0, 0, 0] #red, green, blue, warm white, cold white
+        self.pattern = 0x61
+        self.writes = [] #(time received, raw packet) for every color/power write
+        self.queries = 0
+        self.reads = 0 #Reads from the connections that returned data, roughly the TCP segments received
+        self.dropped = 0
+        self.received = threading.Condition()
+        self._clients = []
+        self._sendLock = threading.Lock()
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(16)
+        self.host, self.port = self._server.getsockname()
+        self._running = True
+        _thread = threading.Thread(target=self._accept, name='FakeBulb-{}'.format(self.port))
+        _thread.daemon = True
+        _thread.start()
+
+    def close(self):
+        self._running = False
+        for _client in list(self._clients):
+            try:
+                _client.close()
+            except socket.error:
+                pass
+        self._server.close()
+
+    def status(self):
+        #14 byte status response, see WifiLedBulb.update_state in flux_led for the layout
+        _msg = bytearray([0x81, self.model, 0x23 if self.on else 0x24, self.pattern, 0x21, 0x06,
+                          self.color[0], self.color[1], self.color[2], self.color[3], 0x01, self.color[4],
+                          0xf0 if any(self.color[:3]) else 0x0f])
+        _msg.append(sum(_msg) & 0xff)
+        return bytes(_msg)
+
+    def remote(self, color=None, on=None):
+        #Change the state as the MagicHome app or an IR remote would
+        with self.received:
+            if color is not None: self.color = list(color) + [0] * (5 - len(color))
+            if on is not None: self.on = on
+            self.pattern = 0x61
+        if self.push:
+            _status = self.status()
+            for _client in list(self._clients):
+                try:
+                    with self._sendLock:
+                        _client.sendall(_status)
+                except socket.error:
+                    pass
+
+    def waitForWrites(self, count, timeout=5.):
+        #Block until at least count writes have been received
+        with self.received:
+            return self.received.wait_for(lambda: len(self.writes) >= count, timeout)
+
+    def _accept(self):
+        while self._running:
+            try:
+                _client, _addr = self._server.accept()
+            except socket.error:
+                return
+            self._clients.append(_client)
+            _thread = threading.Thread(target=self._serve, args=(_client,))
+            _thread.daemon = True
+            _thread.start()
+
+    def _serve(self, client):
+        _buffer = bytearray()
+        try:
+            while self._running:
+                _data = client.recv(1024)
+                if not _data: break
+                self.reads += 1
+                _buffer.extend(_data)
+                while _buffer:
+                    _length = self._packetLength(_buffer)
+                    if _length is None or len(_buffer) < _length: break
+                    _packet = bytes(_buffer[:_length])
+                    del _buffer[:_length]
+                    if self.latency: time.sleep(self.latency)
+                    if self.drop and random.random() < self.drop:
+                        self.dropped += 1
+                        continue
+                    _reply = self._handle(_packet)
+                    if _reply:
+                        with self._sendLock:
+                            client.sendall(_reply)
+        except socket.error:
+            pass
+        finally:
+            if client in self._clients: self._clients.remove(client)
+            client.close()
+
+    def _packetLength(self, buffer):
+        _head = buffer[0]
+        if _head == 0x81: return 4 #81 8a 8b checksum
+        if _head == 0x71: return 4 #71 23|24 0f checksum
+        if _head == 0x61: return 5 #61 pattern delay 0f checksum
+        if _head in (0x31, 0x41): return 9 if self.variant == 'rgbww' else 8
+        return 1 #Unknown byte, skip it
+
+    def _handle(self, packet):
+        _head = packet[0]
+        if _head == 0x81:
+            self.queries += 1
+            return self.status()
+        with self.received:
+            if _head == 0x71:
+                self.on = packet[1] == 0x23
+            elif _head in (0x31, 0x41):
+                _mask = packet[-3]
+                if _mask != 0x0f: #0x0f writes whites only
+                    self.color[0:3] = packet[1:4]
+                if _mask != 0xf0 and self.variant != 'rgb': #0xf0 writes colors only
+                    self.color[3] = packet[4]
+                    if self.variant == 'rgbww': self.color[4] = packet[5]
+                self.pattern = 0x61
+                self.on = True
+            elif _head == 0x61:
+                self.pattern = packet[1]
+                self.on = True
+            else:
+                return None
+            self.writes.append((time.time(), packet))
+            self.received.notify_all()
+        if _head == 0x71:
+            _reply = bytearray([0x0f, 0x71, packet[1]])
+            _reply.append(sum(_reply) & 0xff)
+            return bytes(_reply)
+        return None
+
+
+class FakeFleet(object):
+    """A number of FakeBulbs, variants are assigned round robin."""
+    def __init__(self, count, variants=('rgbw',), latency=0., drop=0., push=False):
+        self.bulbs = [FakeBulb(variants[i % len(variants)], latency, drop, push=push) for i in range(count)]
+
+    def close(self):
+        for _bulb in self.bulbs:
+            _bulb.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    _parser = argparse.ArgumentParser(description='Run simulated MagicHome LED controllers on localhost')
+    _parser.add_argument('-n', '--bulbs', type=int, default=1)
+    _parser.add_argument('--variant', choices=sorted(VARIANTS), action='append')
+    _parser.add_argument('--latency', type=float, default=0., help='seconds added to every request')
+    _parser.add_argument('--drop', type=float, default=0., help='fraction of requests ignored')
+    _args = _parser.parse_args()
+    _fleet = FakeFleet(_args.bulbs, tuple(_args.variant or ['rgbw']), _args.latency, _args.drop)
+    for _bulb in _fleet.bulbs:
+        print('{} {}:{}'.format(_bulb.variant, _bulb.host, _bulb.port))
+    try:
+        while True: time.sleep(60)
+    except KeyboardInterrupt:
+        _fleet.close()
@@ -0,0 +1,121 @@
+"""
+Minimal stand-in for polyinterface so magichome.py can run without Polyglot or an ISY.
+
+Only the parts of the API used by the node server are provided.  Messages that would be sent to Polyglot are
+counted (and kept) by Interface.send instead, so benchmarks can measure driver report volume.
+"""
+
+import logging
+from copy import deepcopy
+
+LOGGER = logging.getLogger('polyinterface')
+
+
+class Interface(object):
+    def __init__(self, name='MagicHome', config=None):
+        self.name = name
+        self.config = config if config is not None else {'customParams': {}, 'nodes': [], 'notices': {}}
+        self.sent = 0
+        self.messages = []
+        self.keepMessages = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def send(self, message):
+        self.sent += 1
+        if self.keepMessages: self.messages.append(message)
+
+    def addNode(self, node):
+        self.send({'addnode': {'address': node.address}})
+
+    def delNode(self, address):
+        self.send({'removenode': {'address': address}})
+
+
+class Node(object):
+    def __init__(self, controller, primary, address, name):
+        self.controller = controller
+        self.parent = self.controller
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.polyConfig = None
+        self.drivers = deepcopy(self.drivers)
+        self._drivers = deepcopy(self.drivers)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                d['value'] = value
+                if uom is not None:
+                    d['uom'] = uom
+                if report:
+                    self.reportDriver(d, report, force)
+                break
+
+    def reportDriver(self, driver, report, force):
+        for d in self._drivers:
+            if d['driver'] == driver['driver'] and (str(d['value']) != str(driver['value']) or d['uom'] != driver['uom'] or force):
+                d['value'] = deepcopy(driver['value'])
+                d['uom'] = driver['uom']
+                self.controller.poly.send({'status': {'address': self.address, 'driver': driver['driver'], 'value': str(driver['value']), 'uom': driver['uom']}})
+                break
+
+    def reportDrivers(self):
+        self._drivers = deepcopy(self.drivers)
+        for driver in self.drivers:
+            self.controller.poly.send({'status': {'address': self.address, 'driver': driver['driver'], 'value': driver['value'], 'uom': driver['uom']}})
+
+    def runCmd(self, command):
+        if command['cmd'] in self.commands:
+            fun = self.commands[command['cmd']]
+            fun(self, command)
+
+    def query(self):
+        self.reportDrivers()
+
+    def start(self):
+        pass
+
+    drivers = []
+    commands = {}
+
+
+class Controller(Node):
+    """Unlike the real Controller, start() is not run automatically and addNode starts the node immediately."""
+    def __init__(self, poly, name='Controller'):
+        self.controller = self
+        self.parent = self.controller
+        self.poly = poly
+        self.name = name
+        self.address = 'controller'
+        self.primary = self.address
+        self.drivers = deepcopy(self.drivers)
+        self._drivers = deepcopy(self.drivers)
+        self.nodes = {self.address: self}
+        self.polyConfig = poly.config
+
+    def addNode(self, node, update=False):
+        self.nodes[node.address] = node
+        self.poly.addNode(node)
+        node.start()
+        return node
+
+    def delNode(self, address):
+        self.nodes.pop(address, None)
+        self.poly.delNode(address)
+
+    def longPoll(self):
+        pass
+
+    def shortPoll(self):
+        pass
+
+    def runForever(self):
+        pass
+
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2}]
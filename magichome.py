@@ -1,665 +1,3001 @@
-#!/usr/bin/env python3
-"""
-This is a NodeServer for controlling magichome/flux-led style LED lights by fahrer16 (Brian Feeney)
-Based on template for Polyglot v2 written in Python2/3 by Einstein.42 (James Milne) milne.james@gmail.com
-"""
-
-import polyinterface
-"""#NEED TO RENAME __main__ to flux_led"""
-from flux_led import BulbScanner, WifiLedBulb
-import sys
-import os
-import json
-import math
-import threading
-
-LOGGER = polyinterface.LOGGER
-CONFIG_FILE = open('server.json')
-SERVERDATA = json.load(CONFIG_FILE)
-CONFIG_FILE.close()
-VERSION = SERVERDATA['credits'][0]['version']
-UPDATE_DELAY = 1.0
-QUERY_BEFORE_CMD = False
-
-# Changing these will not update the ISY names and labels, you will have to edit the profile.
-COLORS = {
-	0: ['RED', [255,0,0]],
-	1: ['ORANGE', [255,165,0]],
-	2: ['YELLOW', [255,255,0]],
-	3: ['GREEN', [0,255,0]],
-	4: ['CYAN', [0,255,255]],
-	5: ['BLUE', [0,0,255]],
-	6: ['PURPLE', [255,0,255]],#Updated 12Jan2020 to have a better color for purple
-	7: ['PINK', [255,192,203]],
-	8: ['WHITE', [255,255,255]],
-	9: ['COLD_WHTE', [201,226,255]],
-	10: ['WARM_WHITE', [255,147,41]],
-	11: ['GOLD', [255,215,0]]
-}
-
-class Controller(polyinterface.Controller):
-    """
-    The Controller Class is the primary node from an ISY perspective. It is a Superclass
-    of polyinterface.Node so all methods from polyinterface.Node are available to this
-    class as well.
-
-    Class Variables:
-    self.nodes: Dictionary of nodes. Includes the Controller node. Keys are the node addresses
-    self.name: String name of the node
-    self.address: String Address of Node, must be less than 14 characters (ISY limitation)
-    self.polyConfig: Full JSON config dictionary received from Polyglot.
-    self.added: Boolean Confirmed added to ISY as primary node
-
-    Class Methods (not including the Node methods):
-    start(): Once the NodeServer config is received from Polyglot this method is automatically called.
-    addNode(polyinterface.Node): Adds Node to self.nodes and polyglot/ISY. This is called for you
-                                 on the controller itself.
-    delNode(address): Deletes a Node from the self.nodes/polyglot and ISY. Address is the Node's Address
-    longPoll(): Runs every longPoll seconds (set initially in the server.json or default 10 seconds)
-    shortPoll(): Runs every shortPoll seconds (set initially in the server.json or default 30 seconds)
-    query(): Queries and reports ALL drivers for ALL nodes to the ISY.
-    runForever(): Easy way to run forever without maxing your CPU or doing some silly 'time.sleep' nonsense
-                  this joins the underlying queue query thread and just waits for it to terminate
-                  which never happens.
-    """
-    def __init__(self, polyglot):
-        super(Controller, self).__init__(polyglot)
-        self.firstRun = True
-        self.name = 'MagicHome Controller'
-
-    def start(self):
-        LOGGER.info('Starting MagicHome LED Polyglot v2 NodeServer version {}'.format(VERSION))
-        self.discover()
-
-    def longPoll(self):
-        self.query()
-
-    def poll(self):
-        pass
-        #for node in self.nodes:
-        #    self.nodes[node].poll()
-
-    def query(self, command=None):
-        for node in self.nodes:
-            self.nodes[node].update_info()
-
-    def update_info(self):
-        pass #Nothing to update for controller
-
-    def discover(self, *args, **kwargs):
-        _success = False
-        try:
-            LOGGER.info('Discovering MagicHome LED Controllers...')
-            _scanner = BulbScanner()
-            _scanner.scan(timeout=5)
-            _devices = _scanner.getBulbInfo()
-            LOGGER.info('%i bulbs found. Checking status and adding to ISY', len(_devices))
-            for d in _devices:
-                self._addNode(d)
-            _success = True
-        except Exception as ex:
-            LOGGER.error('Error running magichome discovery (%s)', str(ex))
-        
-        try:
-            _items = 0
-            self.discoveryTries = 0
-            _params = self.polyConfig['customParams']
-            for key,value in _params.items():
-                _key = key.lower()
-                if _key.startswith('led'):
-                    _items += 1
-                    try:
-                        if 'ip' in value and 'mac' in value:
-                            _value = json.loads(value)
-                            _ip = _value['ip']
-                            _mac = _value['mac'].lower().replace(':','')
-                            d = {'ipaddr': _ip, 'id': _mac}
-                            self._addNode(d)
-                    except Exception as ex:
-                        LOGGER.error('Error adding node from Polyglot configuration (%s): %s', str(value), str(ex))
-            if _items == 0:
-                LOGGER.info('NOTE: LED Controllers can be specified for addition even if not detected via discovery.  Add a custom configuration parameter to Polyglot for each LED controller with a key starting with "LED".  The value should be in the following format, note the use of double quotes: {"ip":"192.168.0.84", "mac":"F0FEAF241937"}  "mac" is the MAC address without colons.')
-        except Exception as ex:
-            LOGGER.error('Error processing custom node addition from Polyglot configuration: %s', str(ex))
-            
-        try:
-            _params = self.polyConfig['customParams']
-            global UPDATE_DELAY
-            if 'delay' in _params:
-                UPDATE_DELAY = float(_params['delay'])
-            else:
-                LOGGER.info("NOTE: A delay can be specified to wait a bit for the LED controller to process commands before querying them to update the controller's state in the ISY.  Defaults to %s sec.", str(UPDATE_DELAY))
-        except Exception as ex:
-            LOGGER.error('Error obtaining device delay value from Polyglot configuration: %s',str(ex))
-        
-        try:
-            _params = self.polyConfig['customParams']
-            global QUERY_BEFORE_CMD
-            if 'query_before_cmd' in _params:
-                QUERY_BEFORE_CMD = bool(_params['query_before_cmd'])
-        except Exception as ex:
-            LOGGER.error('Error obtaining query_before_cmd flag from Polyglot configuration: %s',str(ex))
-
-        self.firstRun = False
-        return _success
-
-    def _addNode(self, d):
-        try:
-            name = 'mh ' + d['ipaddr'].replace('.',' ')
-            address = str(d['id']).lower()
-            address = address[-14:]
-            if address not in self.nodes:
-                led = WifiLedBulb(d['ipaddr'])
-                if led.rgbwcapable:
-                    LOGGER.info('Adding new MagicHome RGBW LED: %s(%s)', name, address)
-                    self.addNode(MagicHomeLED(self, self.address, address, name, device = led)) #Two node types merged, both kept herein for backwards compatability BF 30Jan2020
-                else:
-                    LOGGER.info('Adding new MagicHome RGB LED: %s(%s)', name, address)
-                    self.addNode(MagicHomeLED(self, self.address, address, name, device = led))
-            else:
-                LOGGER.debug('MagicHome LED with IP address "%s" and MAC address "%s" already in ISY', name, address)
-                return False
-        except Exception as ex:
-            LOGGER.error('Error adding Bulb: %s', str(ex))
-            return False
-        return True
-        
-
-    id = 'controller'
-    commands = {'DISCOVER': discover}
-    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2} #Built-in for polyglot v2, do not delete
-              ]
-
-
-class MagicHomeLED(polyinterface.Node):
-    def __init__(self, parent, primary, address, name, device):
-        super().__init__(parent, primary, address, name)
-        self.brightness = 0
-        self.red = 0 
-        self.green = 0
-        self.blue = 0
-        self.white = 0
-        self.white2 = 0
-        self.device = device
-        self.last_red = 0
-        self.last_green = 0
-        self.last_blue = 0
-        self.last_white = 0
-        self.last_white2 = 0
-
-    def start(self):
-        LOGGER.info("%s MagicHome LED ready", self.address)
-        self.update_info()
-
-    def setOn(self, command=None):
-        try:
-            _value = command.get('value')
-            LOGGER.info('Received command to turn on %s (value = %s).', self.address, str(_value))
-            
-            if QUERY_BEFORE_CMD: self.update_info()
-            
-            if _value is not None:
-                _value = int(_value)
-                _str_mode = self.device.mode
-                
-                if _value == 0:
-                    return self.setOff()
-                else:
-                    _existing_color = [self.red, self.green, self.blue, self.white, self.white2]
-                    _max = max(_existing_color)
-                    if _max <= 0: #If the bulb is already off when an on command is issued, use the previous state when the bulb was not off instead
-                        LOGGER.debug('%s is off when on command received, defaulting to white', self.address)
-                        _existing_color = [self.last_red, self.last_green, self.last_blue, self.last_white, self.last_white2]
-                        _max = max(_existing_color)
-                        if _max <= 0:
-                            #maximum is still 0 (no previous state recorded).  Set _existing_color to full on white so we don't run into divide by 0 errors below
-                            #this should only happen if the node server has been reset and this is the first time we're turning on a bulb AND we've specified an on level
-                            _existing_color = [255,255,255,255,255]
-                            _max = max(_existing_color)
-                    _red = int(_existing_color[0] / _max * 255. * _value / 100.)
-                    _green = int(_existing_color[1] / _max * 255. * _value / 100.)
-                    _blue = int(_existing_color[2] / _max * 255. * _value / 100.)
-                    _white = int(_existing_color[3] / _max * 255. * _value / 100.)
-                    _white2 = int(_existing_color[4] / _max * 255. * _value / 100.)
-                    if (_red + _green + _blue) > 0:
-                        if self.device.rgbwcapable:
-                            LOGGER.debug('Setting %s to red=%s, green=%s, blue=%s, white=%s', self.address, str(_red), str(_green), str(_blue), str(_white)) 
-                            self.device.setRgbw(_red, _green, _blue, _white)
-                        else:
-                            LOGGER.debug('Setting %s to red=%s, green=%s, blue=%s', self.address, str(_red), str(_green), str(_blue)) #21Jan2020 Added self.address
-                            self.device.setRgb(_red, _green, _blue)
-                    elif _white > 0 and _white2 > 0:
-                        self.device.setRgbw(w=_white,w2=_white2)
-                    elif _white > 0 and _white2 <= 0:
-                        self.setWW({'value': int(255. * _value / 100.)})
-                    elif _white <= 0 and _white2 > 0:
-                        self.setCW({'value': int(255. * _value / 100.)})
-            else:
-                LOGGER.debug('On command received for %s but no value supplied', self.address)
-                
-                    
-        except Exception as ex:
-            LOGGER.error('Error turning on %s (command=%s). %s', self.address, str(command), str(ex))
-        
-        try:
-            self.device.turnOn()
-        except Exception as ex:
-            LOGGER.error('Error turning on %s. %s', self.address, str(ex))
-        
-        timer = threading.Timer(UPDATE_DELAY, self.update_info)
-        timer.start()
-        
-        return True
-
-    def fastOn(self, command=None):
-        LOGGER.info('Received Fast On Command for %s', self.address)
-        _cmd = {'value': 100}
-        return self.setOn(_cmd)
-
-    def setOff(self, command=None):
-        LOGGER.info('Received command to turn off %s.', self.address)
-        if QUERY_BEFORE_CMD: self.update_info()
-        try:
-            self.device.turnOff()
-            
-            timer = threading.Timer(UPDATE_DELAY, self.update_info)
-            timer.start()
-        
-        except Exception as ex:
-            LOGGER.error('Error turning off %s. %s', self.address, str(ex))
-        return True
-
-    def fastOff(self, command=None):
-        LOGGER.info('Received Fast Off Command for %s', self.address)
-        return self.setOff(0)
-
-    def setBrtDim(self, command):
-        _cmd = command.get('cmd')
-        LOGGER.info('Received %s command on %s', str(_cmd), self.address)
-        try:
-            if _cmd == 'BRT':
-                _brightness = self.brightness + 3
-            else:
-                _brightness = self.brightness - 3
-            _brightness = max(min(brightness,100),0)
-            if _brightness == 0: 
-                return self.setOff()
-            else:
-                self.setOn(_brightness)
-        except Exception as ex:
-            LOGGER.error('Error executing %s command on %s: %s', str(_cmd), self.address, str(ex))
-            return False
-        return True
-
-    def setManual(self, command):
-        try:
-            LOGGER.info('Received manual change command for %s, %s', self.address, str(command))
-            if QUERY_BEFORE_CMD: self.update_info()
-            _cmd = command.get('cmd')
-            _val = int(command.get('value'))
-            _red = _val if _cmd == 'SETR' else self.red
-            _green = _val if _cmd == 'SETG' else self.green
-            _blue = _val if _cmd == 'SETB' else self.blue
-            
-            if (_red + _green + _blue) <= 0: return self.setOff() 
-
-            if self.device.rgbwcapable:
-                _white = _val if _cmd == 'SETW' else self.white
-                self.device.setRgbw(_red, _green, _blue, _white)
-                
-            else:
-                self.device.setRgb(r=_red, g=_green,b=_blue)
-                          
-            timer = threading.Timer(UPDATE_DELAY, self.update_info)
-            timer.start() 
-        except Exception as  ex: 
-            LOGGER.error('Error setting manual rgb on %s (cmd=%s, value=%s). %s', self.address, str(_cmd), str(_val), str(ex))
-            return False
-        return True        
-
-    def setRGB(self, command):
-        try:
-            if QUERY_BEFORE_CMD: self.update_info()
-            _query = command.get('query')
-            _red = int(_query.get('R.uom56'))
-            _green = int(_query.get('G.uom56'))
-            _blue = int(_query.get('B.uom56'))
-            if (_red + _green + _blue) <= 0: return self.setOff()
-            LOGGER.info('Received RGB Command, updating %s to: R:%i G:%i, B:%i', self.address, _red, _green, _blue)
-            self.device.setRgb(_red, _green, _blue)
-            #self.device.turnOn()
-            
-            timer = threading.Timer(UPDATE_DELAY, self.update_info)
-            timer.start()
-        except Exception as  ex: 
-            LOGGER.error('Error setting RGB on %s (%s). %s', self.address, str(command), str(ex))
-            return False
-        return True
-
-    def setColor(self, command):
-        try:
-            if QUERY_BEFORE_CMD: self.update_info()
-            _color = int(command.get('value'))
-            LOGGER.info('Received setColor command, changing %s color to %s', self.address, COLORS[_color][0])
-            _pct_brightness = self.brightness / 100. if self.brightness > 0 else 1 #get brightness as 0-1, default to 100% if the brightness is 0 (light off)
-            _red = int(COLORS[_color][1][0] * _pct_brightness)
-            _green = int(COLORS[_color][1][1] * _pct_brightness)
-            _blue = int(COLORS[_color][1][2] * _pct_brightness)
-            self.device.setRgb(_red, _green, _blue)
-            
-            timer = threading.Timer(UPDATE_DELAY, self.update_info)
-            timer.start()
-        except Exception as  ex: 
-            LOGGER.error('Error seting color on %s (command = %s): %s', self.address, str(command), str(ex))
-            return False
-        return True
-
-    def update_info(self):
-        try:
-            self.device.update_state() #query LED Controller
-        except Exception as ex:
-            LOGGER.error('Error updating device state for %s: %s', self.address, str(ex))
-            return False
-
-        try:           
-            #Update Mode:
-            _str_mode = self.device.mode
-            if _str_mode == 'off' or not self.device.is_on:
-                self.setDriver('GV5',0)
-                self.red = 0
-                self.green = 0
-                self.blue = 0
-                self.white = 0
-                self.white2 = 0
-                self.brightness = 0
-            else:
-                try:
-                    _color = self.device.getRgbww()
-                    self.red = _color[0]
-                    self.green = _color[1]
-                    self.blue = _color[2]
-                    self.white = _color[3]
-                    self.white2 = _color[4]
-                except Exception as ex:
-                        LOGGER.info('Could not get RGBWW for %s: %s', self.address, str(ex))
-                        try:
-                            _color = self.device.getRgbw()
-                            self.red = _color[0]
-                            self.green = _color[1]
-                            self.blue = _color[2]
-                            self.white = _color[3]
-                            self.white2 = 0
-                        except Exception as ex:
-                            LOGGER.info('Could not get RGBW for %s: %s', self.address, str(ex))
-                            _color = self.device.getRgb()
-                            self.red = _color[0]
-                            self.green = _color[1]
-                            self.blue = _color[2]
-                            self.white = 0
-                            self.white2 = 0
-                if _str_mode == 'color':
-                    self.setDriver('GV5',1)
-                elif _str_mode == 'ww':
-                    self.red = 0
-                    self.green = 0
-                    self.blue = 0
-                    try:
-                        self.white = self.device._rgbw[3]
-                        self.white2 = self.device.raw_state[11]
-                    except Exception as ex:
-                            LOGGER.info('Could not retrieve white LED status for %s: %s', self.address, str(ex))
-                    self.setDriver('GV5',2)
-                #TODO: Support for the following modes is not yet fully implemented in the node server:
-                elif _str_mode == 'custom':
-                    self.setDriver('GV5',3)
-                elif _str_mode == 'preset':
-                    self.setDriver('GV5',4)
-                elif _str_mode == 'sunrise':
-                    self.setDriver('GV5',5)
-                elif _str_mode == 'sunset':
-                    self.setDriver('GV5',6)
-                elif _str_mode == 'default':
-                    self.setDriver('GV5',7)
-                else: #unknown
-                    self.setDriver('GV5',8)
-
-                self.brightness = math.ceil(max(self.red, self.green, self.blue, self.white, self.white2) / 255. * 100.)
-                self.last_red = self.red
-                self.last_green = self.green
-                self.last_blue = self.blue
-                self.last_white = self.white
-                self.last_white2 = self.white2
-            
-            self.setDriver('ST', self.brightness)            
-            self.setDriver('GV1', self.red)
-            self.setDriver('GV2', self.green)
-            self.setDriver('GV3', self.blue)
-            self.setDriver('GV6', self.white)
-            self.setDriver('GV7', self.white2)
-            self.setDriver('GV4', 1) #Connected
-            
-        except Exception as ex:
-            LOGGER.error('Error updating device info for %s: %s', self.address, str(ex))
-            self.setDriver('GV4', 0) #Connected = False
-    
-    def setTemperature(self, command):
-        if QUERY_BEFORE_CMD: self.update_info()
-        _temp = int(command.get('value'))
-        #Check that temperature is proper and in correct range (2700K-6500K)
-        if _temp is None:
-            LOGGER.error('Received Set Temperature Command on %s but no value supplied', self.address)
-            return False
-        if (_temp < 2700 or _temp > 6500): 
-            LOGGER.error('Received Set Temperature Command on %s but not within range of 2700-6500K (%i)', self.address, _temp)
-            return False
-
-        #Check that bulb brightness is proper, if it's too low, set it to 100% (255)
-        _brightness = min(max(self.brightness / 100. * 255.,0),255)
-        if _brightness == 0: _brightness = 255
-
-        LOGGER.info('Received Set Temperature Command, updating %s to: %iK, brightness %i', self.address, _temp, _brightness)
-        try:
-            self.device.setWhiteTemperature(_temp, _brightness)
-            #self.SetOn()
-            
-            timer = threading.Timer(UPDATE_DELAY, self.update_info)
-            timer.start()
-        except Exception as  ex: 
-            LOGGER.error('Error setting Temperature on %s (%s). %s', self.address, str(command), str(ex))
-            return False
-        return True
-
-    def setRGBW(self, command):
-        try:
-            if QUERY_BEFORE_CMD: self.update_info()
-            _query = command.get('query')
-            _red = int(_query.get('R.uom56'))
-            _green = int(_query.get('G.uom56'))
-            _blue = int(_query.get('B.uom56'))
-            _white = int(_query.get('W.uom56'))
-            if (_red + _green + _blue + _white) <= 0: return self.setOff()
-            if self.device.rgbwcapable:
-                LOGGER.info('Received RGBW Command, updating %s to: R:%i G:%i, B:%i, W:%i', self.address, _red, _green, _blue, _white)
-                self.device.setRgbw(_red, _green, _blue, _white)
-            elif (_red + _green + _blue) <= 0:
-                self.setWW({'value': _white})
-            else:
-                LOGGER.info('Received RGBW Command but bulb is not RGBW capable, updating %s to: R:%i G:%i, B:%i', self.address, _red, _green, _blue)
-                self.device.setRgb(r=_red, g=_green,b=_blue)
-            self.device.turnOn()
-            
-            timer = threading.Timer(UPDATE_DELAY, self.update_info)
-            timer.start()
-        except Exception as  ex: 
-            LOGGER.error('Error setting RGBW on %s (%s). %s', self.address, str(command), str(ex))
-            return False
-        return True
-    
-    def setWW(self, command):
-        try:
-            _value = command.get('value')
-            
-            if QUERY_BEFORE_CMD: self.update_info()
-            
-            if _value is not None:
-                _value = int(_value)
-                if _value == 0:
-                    return self.setOff()
-                else:
-                    LOGGER.debug('Setting %s to warm white %s', self.address, str(_value))
-                    #self.device.setWarmWhite255(_value)   
-                    self.device.setRgbw(w=_value,w2=self.white2) #Default behavior in flux_led module is to write both warm white and cold white to same value if only one is written.  In order to only write one, we're setting the White2 value to the existing level so that it stays the same
-        except Exception as ex:
-            LOGGER.error('Error setting %s warm white percentage to %s. %s', self.address, str(_value), str(ex))
-        
-        timer = threading.Timer(UPDATE_DELAY, self.update_info)
-        timer.start()
-        
-        return True
- 
-    def setCW(self, command):
-        try:
-            _value = command.get('value')
-            
-            if QUERY_BEFORE_CMD: self.update_info()
-            
-            if _value is not None:
-                _value = int(_value)
-                if _value == 0:
-                    return self.setOff()
-                else:
-                    LOGGER.debug('Setting %s to cold white %s', self.address, str(_value))
-                    #self.device.setColdWhite255(_value)
-                    self.device.setRgbw(w=self.white,w2=_value) #Default behavior in flux_led module is to write both warm white and cold white to same value if only one is written.  In order to only write one, we're setting the White value to the existing level so that it stays the same
-        except Exception as ex:
-            LOGGER.error('Error setting %s cold white percentage to %s. %s', self.address, str(_value), str(ex))
-        
-        timer = threading.Timer(UPDATE_DELAY, self.update_info)
-        timer.start()
-        
-        return True      
-    
-    def query(self, command=None):
-        LOGGER.debug('Querying %s', self.address)
-        self.update_info()
-
-    def longPoll(self):
-        self.query()
-
-    def poll(self):
-        pass
-            
-    drivers = [{'driver': 'ST', 'value': 0, 'uom': 51}, #BRIGHTNESS
-               {'driver': 'GV1', 'value': 0, 'uom': 56}, #RED
-               {'driver': 'GV2', 'value': 0, 'uom': 56}, #GREEN
-               {'driver': 'GV3', 'value': 0, 'uom': 56}, #BLUE
-               {'driver': 'GV6', 'value': 0, 'uom': 56}, #WARM WHITE
-               {'driver': 'GV7', 'value': 0, 'uom': 56}, #COLD WHITE
-               {'driver': 'GV4', 'value': 0, 'uom': 2}, #Connected
-               {'driver': 'GV5', 'value': 8, 'uom': 25} #Mode (Index)
-              ]
-
-    id = 'magichomeled'
-    commands = {
-                    'DON': setOn, 
-                    'DOF': setOff, 
-                    'DFON': fastOn, 
-                    'DFOF': fastOff, 
-                    'QUERY': query,
-                    'BRT': setBrtDim, 'DIM': setBrtDim, 
-                    'SET_COLOR': setColor, 
-                    'SETR': setManual, 'SETG': setManual, 'SETB': setManual, 'SETW': setManual,
-                    'SET_RGB': setRGB,
-                    'SET_RGBW': setRGBW,
-                    'SETWW': setWW,
-                    'SETCW': setCW,
-                    'SET_TEMP': setTemperature
-                }
-
-class MagicHomeWWLED(MagicHomeLED): #Provided for backward compatability
-   
-    def update_info(self):
-        super().update_info()
-        
-
-    def setTemperature(self, command):
-        super().setTemperature(command)
-
-    def setRGBW(self, command):
-        super().setRGBW(command)
-
-    def setOn(self, command=None):
-        super().setOn(command)
-
-    def setOff(self, command=None):
-        super().setOff(command)
-
-    def fastOn(self, command=None):
-        super().fastOn(command)
-
-    def fastOff(self, command=None):
-        super().fastOff(command)
-
-    def query(self, command=None):
-        super().query(command)
-
-    def setBrtDim(self, command=None):
-        super().setBrtDim(command)
-
-    def setColor(self, command):
-        super().setColor(command)
-
-    def setManual(self, command):
-        super().setManual(command)
-
-    def setRGB(self, command):
-        super().setRGB(command)
-    
-    def setWW(self, command):
-        super().setWW(command)
- 
-    def setCW(self, command):
-        super().setCW(command)
-
-    def longPoll(self):
-        super().longPoll(self)
-
-    def poll(self):
-        super().poll(self)
-
-    drivers = [{'driver': 'ST', 'value': 0, 'uom': 51}, #BRIGHTNESS
-               {'driver': 'GV1', 'value': 0, 'uom': 56}, #RED
-               {'driver': 'GV2', 'value': 0, 'uom': 56}, #GREEN
-               {'driver': 'GV3', 'value': 0, 'uom': 56}, #BLUE
-               {'driver': 'GV6', 'value': 0, 'uom': 56}, #WARM WHITE
-               {'driver': 'GV7', 'value': 0, 'uom': 56}, #COLD WHITE
-               {'driver': 'GV4', 'value': 0, 'uom': 2}, #Connected
-               {'driver': 'GV5', 'value': 8, 'uom': 25} #Mode (Index)
-              ]
-
-    id = 'magichomewwled'
-    commands = {
-                    'DON': setOn, 
-                    'DOF': setOff, 
-                    'DFON': fastOn, 
-                    'DFOF': fastOff, 
-                    'QUERY': query,
-                    'BRT': setBrtDim, 'DIM': setBrtDim, 
-                    'SET_COLOR': setColor, 
-                    'SETR': setManual, 'SETG': setManual, 'SETB': setManual, 'SETW': setManual,
-                    'SET_RGB': setRGB,
-                    'SET_RGBW': setRGBW,
-                    'SETWW': setWW,
-                    'SETCW': setCW,
-                    'SET_TEMP': setTemperature
-                }
-
-
-if __name__ == "__main__":
-    try:
-        polyglot = polyinterface.Interface('MagicHome')
-        polyglot.start()
-        control = Controller(polyglot)
-        control.runForever()
-    except (KeyboardInterrupt, SystemExit):
-        sys.exit(0)
+#!/usr/bin/env python3
+"""
+This is a NodeServer for controlling magichome/flux-led style LED lights by fahrer16 (Brian Feeney)
+Based on template for Polyglot v2 written in Python2/3 by Einstein.42 (James Milne) milne.james@gmail.com
+"""
+
+import time
+IMPORT_STARTED = time.monotonic() #For the startup timing report
+import multiprocessing
+WORKER_NAME = 'magichome-worker' #Name prefix of the worker processes, see WorkerPool
+if multiprocessing.current_process().name.startswith(WORKER_NAME):
+    #A worker process imports this module only for the LED controller I/O, polyinterface would take over its stdin, stdout and log file
+    import logging
+    import types
+    logging.basicConfig(format='%(asctime)s %(processName)s %(levelname)s: %(message)s', level=logging.WARNING) #To stderr
+    polyinterface = types.SimpleNamespace(Node=object, Controller=object, LOGGER=logging.getLogger(WORKER_NAME))
+else:
+    import polyinterface
+"""#NEED TO RENAME __main__ to flux_led"""
+import sys
+import os
+import json
+import math
+import socket
+import threading
+import heapq
+import itertools
+import functools
+import bisect
+import random
+import array
+import weakref
+import atexit
+import selectors
+import zlib
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+
+LOGGER = polyinterface.LOGGER
+UPDATE_DELAY = 1.0
+QUERY_BEFORE_CMD = False
+STATE_MAX_AGE = 10.0 #With QUERY_BEFORE_CMD, seconds the local state is trusted after it was last written or queried
+POLL_WORKERS = 16 #Maximum number of LED controllers queried at the same time during a poll
+POLL_TIMEOUT = 10.0 #Seconds each LED controller is given to respond during a poll
+COMMAND_WORKERS = 16 #Maximum number of group member commands sent at the same time, on threads of their own so polls don't hold them up
+CONNECT_TIMEOUT = 3.0 #Seconds to wait for a TCP connection to an LED controller
+OP_TIMEOUT = 10.0 #Seconds a query or write to an LED controller may take, retries included, before the Watchdog abandons its connection
+BACKOFF_BASE = 2.0 #Seconds to wait before the second reconnect attempt to an LED controller that is down, doubled for each failure after that
+BACKOFF_MAX = 300.0 #Maximum seconds between reconnect attempts to an LED controller that is down
+DISCOVERY_CACHE_FILE = 'discovery_cache.json' #LED controllers found previously, used to add nodes immediately on restart.  Empty to disable.
+DISCOVERY_INTERVAL = 0.0 #Seconds between the discovery broadcasts of continuous discovery, 0 to only discover at startup and on DISCOVER
+DISCOVERY_MIN_GAP = 60.0 #Minimum seconds between the early broadcasts continuous discovery sends when an LED stops responding
+DISCOVERY_ADDRESS = '<broadcast>' #Where continuous discovery sends its broadcasts, e.g. the broadcast address of one subnet
+DISCOVERY_PORT = 48899 #UDP port the LED controllers answer discovery broadcasts on
+STATE_JOURNAL_FILE = 'state_journal.jsonl' #Last color of each LED while on, kept across restarts.  Empty to disable.
+STATE_JOURNAL_DELAY = 5.0 #Seconds changes to the last colors are collected before being appended to STATE_JOURNAL_FILE
+STATE_JOURNAL_FSYNC = 60.0 #Minimum seconds between fsyncs of STATE_JOURNAL_FILE
+STATE_JOURNAL_COMPACT = 4 #STATE_JOURNAL_FILE is rewritten with one line per LED when it has more lines than this per LED
+ADAPTIVE_POLL = True #Poll each LED on its own schedule from shortPoll instead of polling all of them every longPoll
+POLL_MIN = 5.0 #Seconds between polls of an LED that just changed
+POLL_MAX = 60.0 #Maximum seconds between polls of an LED whose state is stable
+POLL_OFFLINE_MAX = 600.0 #Maximum seconds between polls of an LED that can't be reached
+COALESCE_WINDOW = 0.05 #Seconds to collect BRT/DIM and SETR/SETG/SETB/SETW changes before writing the latest one to the LED controller
+PIPELINE_QUERY = False #Send the status query in the same write as the command and report the reply, instead of querying UPDATE_DELAY later
+WRITE_RATE = 0.0 #Sustained writes per second to each LED controller, 0 for no limit
+WRITE_BURST = 3 #With WRITE_RATE, writes sent back to back before the rate applies
+TRANSITION_FPS = 20.0 #Frames per second streamed to each LED during a fade
+PACKET_CACHE = True #Send color and on/off commands as cached, pre-built packets instead of building them in flux_led for every command
+STATS_FILE = 'stats.json' #Latency histograms and counters written every STATS_INTERVAL, Prometheus text format if the name ends in .prom.  Empty to disable.
+STATS_INTERVAL = 60.0 #Seconds between writes of STATS_FILE and updates of the controller's statistics drivers
+PUSH_LISTEN = False #Listen for status changes the LED controllers send on their own, e.g. after a change from the MagicHome app
+PUSH_RESYNC = 600.0 #With PUSH_LISTEN, seconds between polls of an LED that pushes its status changes
+WORKER_PROCESSES = 0 #Processes doing the network I/O of the LED controllers, sharded by node address.  0 does it in this process.
+PROFILE = False #Time the command and poll hot paths and sample them with cProfile
+PROFILE_SAMPLE = 0.01 #With PROFILE, fraction of calls run under cProfile
+PROFILE_INTERVAL = 900.0 #With PROFILE, seconds between writes of PROFILE_FILE
+PROFILE_FILE = 'profile.pstats' #cProfile samples (pstats format, e.g. for snakeviz or flameprof), with a text summary in PROFILE_FILE.txt
+
+# Changing these will not update the ISY names and labels, you will have to edit the profile.
+COLORS = {
+	0: ['RED', [255,0,0]],
+	1: ['ORANGE', [255,165,0]],
+	2: ['YELLOW', [255,255,0]],
+	3: ['GREEN', [0,255,0]],
+	4: ['CYAN', [0,255,255]],
+	5: ['BLUE', [0,0,255]],
+	6: ['PURPLE', [255,0,255]],#Updated 12Jan2020 to have a better color for purple
+	7: ['PINK', [255,192,203]],
+	8: ['WHITE', [255,255,255]],
+	9: ['COLD_WHTE', [201,226,255]],
+	10: ['WARM_WHITE', [255,147,41]],
+	11: ['GOLD', [255,215,0]]
+}
+
+@functools.lru_cache(maxsize=1)
+def serverVersion():
+    #Read from server.json when first needed rather than when the module is imported
+    with open('server.json') as _file:
+        return json.load(_file)['credits'][0]['version']
+
+
+_fluxLock = threading.Lock()
+_flux = None #The flux_led module, imported by loadFluxLed()
+
+def loadFluxLed():
+    """
+    Imports flux_led and creates ManagedBulb from it the first time an LED controller is needed, so that
+    importing this module and reporting the node server to Polyglot don't wait for it.
+    """
+    global _flux, ManagedBulb, RemoteBulb
+    with _fluxLock:
+        if _flux is None:
+            import flux_led
+            ManagedBulb = type('ManagedBulb', (BulbConnection, flux_led.WifiLedBulb), {'__doc__': BulbConnection.__doc__, '__module__': __name__})
+            RemoteBulb = type('RemoteBulb', (RemoteConnection, ManagedBulb), {'__doc__': RemoteConnection.__doc__, '__module__': __name__})
+            _flux = flux_led
+    return _flux
+
+
+def __getattr__(name):
+    #Module attributes created on first use, e.g. magichome.ManagedBulb
+    if name in ('ManagedBulb', 'RemoteBulb'):
+        loadFluxLed()
+        return globals()[name]
+    if name == 'VERSION':
+        return serverVersion()
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+@functools.lru_cache(maxsize=8192)
+def colorPacket(protocol, rgbwprotocol, red=None, green=None, blue=None, white=None, white2=None, persist=True):
+    """
+    Bytes, including the checksum, that flux_led's WifiLedBulb.setRgbw sends to an LED controller using protocol.
+    As in setRgbw, channels left as None are masked out of the write.  Commands only use a small set of colors
+    (named colors at 101 brightness levels, common RGB values) so the packets are built once and reused.
+    """
+    if protocol == 'LEDENET_ORIGINAL':
+        return bytes([0x56, int(red or 0), int(green or 0), int(blue or 0), 0xaa]) #No checksum in the original protocol
+    _msg = bytearray([0x31 if persist else 0x41, int(red or 0), int(green or 0), int(blue or 0), int(white or 0)])
+    if protocol == 'LEDENET':
+        _msg.append(int(white2) if white2 is not None else int(white or 0)) #Cold white defaults to the warm white value
+    _mask = 0x00
+    if not rgbwprotocol:
+        if white is None and white2 is None:
+            _mask = 0xf0 #Colors only
+        elif red is None and green is None and blue is None:
+            _mask = 0x0f #Whites only
+    _msg.extend((_mask, 0x0f))
+    _msg.append(sum(_msg) & 0xff)
+    return bytes(_msg)
+
+
+@functools.lru_cache(maxsize=8)
+def powerPacket(protocol, on):
+    #Bytes, including the checksum, of flux_led's turnOn/turnOff message
+    if protocol == 'LEDENET_ORIGINAL':
+        return bytes([0xcc, 0x23 if on else 0x24, 0x33])
+    _msg = bytearray([0x71, 0x23 if on else 0x24, 0x0f])
+    _msg.append(sum(_msg) & 0xff)
+    return bytes(_msg)
+
+
+@functools.lru_cache(maxsize=2048)
+def namedColor(color, brightness):
+    #RGB values of one of the COLORS at a brightness (0-100%, 0 meaning 100%)
+    _pct_brightness = brightness / 100. if brightness > 0 else 1
+    return tuple(int(c * _pct_brightness) for c in COLORS[color][1])
+
+
+def namedColors(color, brightnesses):
+    #namedColor for many LEDs at once, e.g. the members of a group
+    return [namedColor(color, b) for b in brightnesses]
+
+
+#Color conversions done for every command and status report, from lookup tables or memoized.  Each gives
+#exactly the values the per-call code it replaced did, bench/bench_colors.py checks that and times both.
+KELVIN_MIN = 2700 #Color temperature of the warm white LEDs, the lowest SET_TEMP accepts
+KELVIN_MAX = 6500 #Color temperature of the cold white LEDs, the highest SET_TEMP accepts
+BRIGHTNESS_PCT = array.array('B', (math.ceil(v / 255. * 100.) for v in range(256))) #Brightness percentage (ST) of a channel value
+
+
+def brightnessOf(*channels):
+    #Brightness percentage of a color, that of its brightest channel
+    _max = max(channels)
+    try:
+        return BRIGHTNESS_PCT[_max]
+    except (IndexError, TypeError): #Not a whole channel value
+        return math.ceil(_max / 255. * 100.)
+
+
+
+@functools.lru_cache(maxsize=1024)
+def _fullColor(color):
+    #color (a tuple of channel values) with its brightest channel at 255, before scaling to a level
+    _max = max(color)
+    return tuple(_c / _max * 255. for _c in color)
+
+
+def scaleColor(color, level):
+    #color (a tuple of channel values) scaled so its brightest channel is at level percent
+    return tuple(int(_c * level / 100.) for _c in _fullColor(color))
+
+
+def scaleColors(colors, level):
+    #scaleColor for many LEDs at once, e.g. the members of a group
+    return [tuple(int(_c * level / 100.) for _c in _fullColor(tuple(color))) for color in colors]
+
+
+@functools.lru_cache(maxsize=None)
+def _kelvinTables():
+    #Warm and cold white for each Kelvin at full brightness, as flux_led's setWhiteTemperature scales them, built on first use
+    _span = KELVIN_MAX - KELVIN_MIN
+    _warm = array.array('d', (255 * (1 - (t / _span)) for t in range(_span + 1)))
+    _cold = array.array('d', (min(255 * t / _span, 255) for t in range(_span + 1)))
+    return _warm, _cold
+
+
+def temperatureWhites(kelvin, brightness):
+    #Warm and cold white for a color temperature at a brightness (0-255), the values flux_led's setWhiteTemperature writes
+    _warm, _cold = _kelvinTables()
+    _index = min(max(int(kelvin), KELVIN_MIN), KELVIN_MAX) - KELVIN_MIN
+    return _warm[_index] * (brightness / 255), _cold[_index] * (brightness / 255)
+
+
+def temperatureColors(kelvin, brightnesses):
+    #temperatureWhites for many LEDs at once, e.g. the members of a group
+    _warm, _cold = _kelvinTables()
+    _index = min(max(int(kelvin), KELVIN_MIN), KELVIN_MAX) - KELVIN_MIN
+    _warm, _cold = _warm[_index], _cold[_index]
+    return [(_warm * (b / 255), _cold * (b / 255)) for b in brightnesses]
+
+
+class DeviceOffline(socket.error):
+    """
+    Raised instead of attempting a connection to an LED controller that is known to be down.
+    Subclasses socket.error so flux_led's own retry handling treats it like any other connection failure.
+    """
+    pass
+
+
+_opLock = threading.Lock() #Guards the operation tracking of all LED controllers, see watched
+
+
+def watched(method):
+    #Tracks the call as an operation on the LED controller for the Watchdog, see BulbConnection.opStarted
+    @functools.wraps(method)
+    def _watched(self, *args, **kwargs):
+        self._opBegin()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._opEnd()
+    return _watched
+
+
+class WriteLimiter(object):
+    """
+    Token bucket in front of the writes to one LED controller, the cheap ones drop their connection when written
+    to faster than a few times per second.  Up to WRITE_BURST writes go out back to back, then WRITE_RATE per
+    second.  Writes waiting for a token are queued by priority, on/off (ON) before colors and patterns (COLOR),
+    and a color write still waiting is dropped when a newer one arrives since only the latest color matters.
+    """
+    ON, COLOR = 0, 1
+
+    def __init__(self):
+        self.tokens = float(WRITE_BURST)
+        self.depth = 0 #Writes waiting now
+        self.maxDepth = 0
+        self.waited = 0 #Writes that had to wait for a token
+        self.waitTime = 0. #Seconds spent waiting, in total
+        self.superseded = 0 #Color writes dropped for a newer one while waiting
+        self._updated = time.monotonic()
+        self._heap = []
+        self._latest = {} #Key -> waiting entry that a newer write with the same key supersedes
+        self._counter = itertools.count()
+        self._cv = threading.Condition()
+
+    def _refill(self):
+        _now = time.monotonic()
+        self.tokens = min(self.tokens + (_now - self._updated) * WRITE_RATE, float(WRITE_BURST))
+        self._updated = _now
+
+    def acquire(self, priority, key=None):
+        #Wait for a token, returns False instead if a newer write with the same key replaced this one meanwhile
+        with self._cv:
+            self._refill()
+            if not self._heap and self.tokens >= 1.:
+                self.tokens -= 1.
+                return True
+            _entry = [priority, next(self._counter), key, False]
+            if key is not None:
+                _older = self._latest.get(key)
+                if _older is not None:
+                    _older[3] = True
+                    self._heap.remove(_older)
+                    heapq.heapify(self._heap)
+                    self.superseded += 1
+                self._latest[key] = _entry
+            heapq.heappush(self._heap, _entry)
+            self._cv.notify_all() #Wakes a superseded write, and the head of the queue if this one goes first
+            self.depth = len(self._heap)
+            self.maxDepth = max(self.maxDepth, self.depth)
+            self.waited += 1
+            _start = time.monotonic()
+            try:
+                while not _entry[3]:
+                    self._refill()
+                    if self._heap[0] is _entry and self.tokens >= 1.:
+                        heapq.heappop(self._heap)
+                        self.tokens -= 1.
+                        return True
+                    self._cv.wait((1. - self.tokens) / WRITE_RATE if self._heap[0] is _entry and WRITE_RATE > 0 else None)
+                return False
+            finally:
+                if key is not None and self._latest.get(key) is _entry: del self._latest[key]
+                self.depth = len(self._heap)
+                self.waitTime += time.monotonic() - _start
+                self._cv.notify_all()
+
+    def tryAcquire(self):
+        #Take a token if one is available and no write is waiting, without waiting
+        with self._cv:
+            self._refill()
+            if self._heap or self.tokens < 1.: return False
+            self.tokens -= 1.
+            return True
+
+    def stats(self):
+        return {'depth': self.depth, 'maxDepth': self.maxDepth, 'waited': self.waited, 'waitTime': round(self.waitTime, 3), 'superseded': self.superseded}
+
+
+class BulbConnection(object):
+    """
+    Mixed into flux_led's WifiLedBulb as ManagedBulb (see loadFluxLed), keeps one persistent connection to
+    the LED controller and tracks its health.
+
+    flux_led reconnects for every status query and retries a failed connection several times, each
+    attempt blocking for the full socket timeout.  Here the connection is kept open (with TCP keepalive)
+    and only re-established lazily when a send fails.  After a failure the controller is not contacted
+    again until its backoff expires: the first reconnect is immediate, later ones wait BACKOFF_BASE
+    seconds doubling up to BACKOFF_MAX.  Until then, commands fail immediately with DeviceOffline.
+
+    If info (an entry from the DiscoveryCache) is supplied, the controller's capabilities are taken from
+    it and no connection is made until the bulb is first used.
+
+    Every socket operation is bounded by the socket timeout.  Queries and writes are also tracked (opStarted)
+    so the Watchdog can abandon the connection of one that takes longer than OP_TIMEOUT in total.
+    """
+    def __init__(self, ipaddr, port=5577, timeout=5, info=None):
+        self.online = False
+        self.failures = 0
+        self.retryAt = 0.
+        self.opStarted = 0. #time.monotonic() when the running query or write started, 0 if there is none
+        self.timeouts = 0 #Operations abandoned by the Watchdog
+        self._ops = 0 #Queries and writes running or waiting for the connection
+        self._abandonedOp = 0. #opStarted of the operation last abandoned
+        self._connLock = threading.RLock()
+        self._limiter = None #WriteLimiter, created on the first write when WRITE_RATE is set
+        self._reserved = False #A token taken by reserveWrite, used by the next write
+        self._pipelined = None #Status read by sendBatch, returned by the next query_state
+        self._deferred = info is not None
+        super().__init__(ipaddr, port, timeout)
+        if info is not None:
+            self.rgbwcapable = info.get('rgbwcapable', False)
+            self.rgbwprotocol = info.get('rgbwprotocol', False)
+            self.protocol = info.get('protocol')
+            self._use_csum = self.protocol != 'LEDENET_ORIGINAL'
+            self._deferred = False
+
+    @watched
+    def update_state(self, retry=2):
+        if self._deferred: return #Constructed from cached information, skip the initial query
+        super().update_state(retry)
+
+    def _opBegin(self):
+        with _opLock:
+            if self._ops == 0: self.opStarted = time.monotonic()
+            self._ops += 1
+
+    def _opEnd(self):
+        with _opLock:
+            self._ops -= 1
+            if self._ops == 0: self.opStarted = 0.
+
+    def abandon(self, started):
+        """
+        Called by the Watchdog when the operation that started at started is still running after OP_TIMEOUT.
+        Shuts the socket down, which fails a send or receive blocked on it in another thread, and marks the
+        controller offline.  Doesn't wait for the connection lock, the stuck operation is holding it.
+        """
+        with _opLock:
+            if self.opStarted != started or self._abandonedOp == started: return False
+            self._abandonedOp = started
+            self.timeouts += 1
+        _socket = self._socket
+        self.online = False
+        if _socket is not None:
+            try:
+                _socket.shutdown(socket.SHUT_RDWR)
+            except (socket.error, OSError):
+                pass
+        return True
+
+    def _read_msg(self, expected):
+        #flux_led reads by polling a non-blocking socket and leaves it blocking without a timeout, read with the timeout instead
+        rx = bytearray()
+        _deadline = time.monotonic() + self.timeout
+        try:
+            while len(rx) < expected:
+                _left = _deadline - time.monotonic()
+                if _left <= 0: break
+                self._socket.settimeout(_left)
+                _chunk = self._socket.recv(expected - len(rx))
+                if not _chunk: raise socket.error('Connection closed by {}'.format(self.ipaddr))
+                rx.extend(_chunk)
+        except socket.timeout:
+            pass
+        finally:
+            if self._socket is not None: self._socket.settimeout(self.timeout)
+        return rx
+
+    @property
+    def state(self):
+        if self.online: return 'connected'
+        if time.monotonic() < self.retryAt: return 'backoff'
+        return 'disconnected'
+
+    def connect(self, retry=0):
+        with self._connLock:
+            if self.online or self._deferred: return
+            if time.monotonic() < self.retryAt:
+                raise DeviceOffline('{} is offline, next connection attempt in {:.1f} sec'.format(self.ipaddr, self.retryAt - time.monotonic()))
+            if self._abandonedOp and self._abandonedOp == self.opStarted: #Don't let flux_led's retries start over
+                raise DeviceOffline('{} did not respond within {} sec'.format(self.ipaddr, OP_TIMEOUT))
+            self.close()
+            try:
+                _socket = socket.create_connection((self.ipaddr, self.port), timeout=CONNECT_TIMEOUT)
+            except socket.error as ex:
+                self._markFailed(ex)
+                raise DeviceOffline('Could not connect to {}: {}'.format(self.ipaddr, str(ex)))
+            _socket.settimeout(self.timeout)
+            _socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'): #Not available on all platforms
+                _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+                _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+            self._socket = _socket
+            self.online = True
+            if self.failures > 0:
+                LOGGER.info('Reconnected to %s after %i failed attempt(s)', self.ipaddr, self.failures)
+            self.failures = 0
+
+    @watched
+    def reconnect(self, ipaddr=None):
+        #Drop the current connection and any backoff and connect again, to a new IP address if one is given
+        with self._connLock:
+            if ipaddr is not None: self.ipaddr = ipaddr
+            self.online = False
+            self.retryAt = 0.
+            self.connect()
+
+    def _markFailed(self, ex):
+        with self._connLock:
+            self.online = False
+            self.failures += 1
+            _delay = 0. if self.failures == 1 else min(BACKOFF_BASE * 2 ** (self.failures - 2), BACKOFF_MAX)
+            self.retryAt = time.monotonic() + _delay
+            self.close()
+            LOGGER.debug('Connection to %s failed (%s), %i consecutive failure(s), retrying in %.1f sec', self.ipaddr, str(ex), self.failures, _delay)
+
+    def _drain(self):
+        #Discard anything the controller sent that was not read, so it isn't mistaken for the next response
+        try:
+            self._socket.setblocking(0)
+            while self._socket.recv(64): pass
+        except socket.error:
+            pass
+        finally:
+            self._socket.settimeout(self.timeout)
+
+    def _send_msg(self, bytes):
+        with self._connLock:
+            if not self.online: self.connect()
+            try:
+                super()._send_msg(bytes)
+            except socket.error as ex:
+                self._markFailed(ex)
+                raise
+
+    def sendPacket(self, packet, retry=1):
+        #Send a complete, pre-built packet (see colorPacket and powerPacket) over the persistent connection
+        with self._connLock:
+            if not self.online: self.connect()
+            try:
+                with self._lock:
+                    self._socket.sendall(packet)
+            except socket.error as ex:
+                self._markFailed(ex)
+                if retry > 0 and not isinstance(ex, DeviceOffline):
+                    return self.sendPacket(packet, retry - 1)
+                raise
+
+    def _getLimiter(self):
+        if self._limiter is None:
+            with _opLock:
+                if self._limiter is None: self._limiter = WriteLimiter()
+        return self._limiter
+
+    def limitWrite(self, priority, key=None):
+        #Wait until the write may be sent to the LED controller (see WriteLimiter), False if it was superseded
+        if WRITE_RATE <= 0: return True
+        with _opLock:
+            if self._reserved:
+                self._reserved = False
+                return True
+        self._opEnd() #Waiting for the rate limit doesn't count towards OP_TIMEOUT
+        try:
+            return self._getLimiter().acquire(priority, key)
+        finally:
+            self._opBegin()
+
+    def reserveWrite(self, wait=True):
+        """
+        Take the token for the next color write ahead of it, so it can be written while holding a lock without waiting
+        for the rate limit.  Without wait, returns False instead of waiting when no token is available.
+        """
+        if WRITE_RATE <= 0 or self._reserved: return True
+        _limiter = self._getLimiter()
+        _ok = _limiter.acquire(WriteLimiter.COLOR, 'color') if wait else _limiter.tryAcquire()
+        if _ok: self._reserved = True
+        return _ok
+
+    def writeQueueStats(self):
+        return self._limiter.stats() if self._limiter is not None else None
+
+    @watched
+    def setPresetPattern(self, pattern, speed):
+        if not self.limitWrite(WriteLimiter.COLOR, 'color'): return
+        super().setPresetPattern(pattern, speed)
+
+    def statusQueryPacket(self):
+        #The status query flux_led's query_state sends
+        if self.protocol == 'LEDENET_ORIGINAL': return b'\xef\x01\x77'
+        return b'\x81\x8a\x8b\x96' if self._use_csum else b'\x81\x8a\x8b'
+
+    @watched
+    def sendBatch(self, packets, query=False, priority=None, retry=1):
+        """
+        Send several pre-built packets in a single write.  With query, the status query is sent in the same
+        write and its reply read on the same connection and applied as by update_state.  Returns True if the
+        status was updated, the query is left out while the reply length is not yet known (first query).
+        """
+        self.limitWrite(WriteLimiter.ON if priority is None else priority)
+        with self._connLock:
+            _query = query and self._query_len > 0
+            _data = b''.join(packets) + (self.statusQueryPacket() if _query else b'')
+            while True:
+                if not self.online: self.connect()
+                try:
+                    if _query: self._drain()
+                    with self._lock:
+                        self._socket.sendall(_data)
+                    if not _query: return False
+                    rx = self._read_msg(self._query_len)
+                    while len(rx) >= 4 and rx[0] == 0x0f: #Acknowledgement of a packet sent before the query, e.g. 0f 71 23 a3 for on
+                        rx = rx[4:] + self._read_msg(4)
+                    break
+                except socket.error as ex:
+                    self._markFailed(ex)
+                    if retry <= 0 or isinstance(ex, DeviceOffline): raise
+                    retry -= 1
+            if len(rx) < self._query_len:
+                self._markFailed('no response to pipelined status query')
+                raise DeviceOffline('{} did not respond to status query'.format(self.ipaddr))
+            self._pipelined = rx
+            try:
+                super().update_state(0)
+            finally:
+                self._pipelined = None
+            return True
+
+    def setRgbwOn(self, r=None, g=None, b=None, w=None, w2=None, persist=True, query=False):
+        #setRgbw and turnOn in a single write, see sendBatch.  Returns True if the status was queried with them.
+        if not PACKET_CACHE:
+            self.setRgbw(r, g, b, w, persist=persist, w2=w2)
+            self.turnOn()
+            if query: self.update_state()
+            return query
+        if (r or g or b) and (w or w2) and not self.rgbwcapable:
+            raise ValueError('RGBW command sent to non-RGBW device {}'.format(self.ipaddr))
+        self._is_on = True
+        return self.sendBatch((colorPacket(self.protocol, self.rgbwprotocol, r, g, b, w, w2, persist), powerPacket(self.protocol, True)), query)
+
+    @watched
+    def setRgbw(self, r=None, g=None, b=None, w=None, persist=True, brightness=None, retry=2, w2=None):
+        if not self.limitWrite(WriteLimiter.COLOR, 'color'): return #A newer color was written instead
+        if not PACKET_CACHE: return super().setRgbw(r, g, b, w, persist=persist, brightness=brightness, retry=retry, w2=w2)
+        if (r or g or b) and (w or w2) and not self.rgbwcapable:
+            raise ValueError('RGBW command sent to non-RGBW device {}'.format(self.ipaddr))
+        if brightness is not None:
+            r, g, b = self._calculateBrightness((r, g, b), brightness)
+        self.sendPacket(colorPacket(self.protocol, self.rgbwprotocol, r, g, b, w, w2, persist), min(retry, 1))
+
+    @watched
+    def _change_state(self, retry, turn_on=True):
+        self.limitWrite(WriteLimiter.ON)
+        if not PACKET_CACHE: return super()._change_state(retry, turn_on)
+        self.sendPacket(powerPacket(self.protocol, turn_on), min(retry, 1))
+
+    def applyStatus(self, rx):
+        #Take a status frame sent by the LED controller without a query, parsed as in flux_led's update_state
+        _mode = self._determineMode(rx[9], rx[3])
+        if _mode == 'unknown': return False
+        if rx[2] == 0x23:
+            self._is_on = True
+        elif rx[2] == 0x24:
+            self._is_on = False
+        self.raw_state = bytearray(rx)
+        self._mode = _mode
+        return True
+
+    def query_state(self, retry=2, led_type=None):
+        with self._connLock:
+            self.connect()
+            if self._query_len == 0:
+                try:
+                    self._determine_query_len() #Only reads the first 2 bytes of the response, the rest is drained below
+                except IndexError:
+                    pass #flux_led fails this way when there is no response at all
+                if self._query_len == 0:
+                    self._markFailed('no response to protocol detection')
+                    raise DeviceOffline('{} did not respond to protocol detection'.format(self.ipaddr))
+            if self._pipelined is not None: return self._pipelined #Read by sendBatch
+            self._drain()
+            rx = super().query_state(retry, led_type)
+            if rx is None or len(rx) < self._query_len:
+                self._markFailed('no response to status query')
+                raise DeviceOffline('{} did not respond to status query'.format(self.ipaddr))
+            return rx
+
+
+class RemoteConnection(object):
+    """
+    Mixed into ManagedBulb as RemoteBulb (see loadFluxLed) when WORKER_PROCESSES is set: a local copy of a
+    ManagedBulb that lives in one of the worker processes.  Calls that talk to the LED controller are sent
+    to the worker, and the state the worker returns with each reply is copied in, so the nodes read color,
+    mode and capabilities locally as before.
+    """
+    STATE = ('rgbwcapable', 'rgbwprotocol', 'protocol', '_use_csum', '_query_len', 'raw_state', '_is_on', '_mode', 'online', 'failures', '_writeQueue', 'workerTimeouts')
+
+    def __init__(self, workers, address, ipaddr, port=5577, state=None):
+        self.workers = workers
+        self.address = address
+        self._writeQueue = None
+        self.workerTimeouts = 0 #Operations abandoned by the worker's own Watchdog
+        super().__init__(ipaddr, port, info=state or {}) #No connection is made from this process
+        if state: self.applyState(state)
+
+    def applyState(self, state):
+        for _name in self.STATE:
+            if _name in state: setattr(self, _name, state[_name])
+        self.retryAt = time.monotonic() + state.get('retryIn', 0.)
+
+    @watched
+    def _call(self, method, *args, **kwargs):
+        return self.workers.call(self, method, args, kwargs)[0]
+
+    def abandon(self, started):
+        #The worker's Watchdog recycles the connection, here the call is only counted and failed by WorkerPool's timeout
+        with _opLock:
+            if self.opStarted != started or self._abandonedOp == started: return False
+            self._abandonedOp = started
+            self.timeouts += 1
+        return True
+
+    def connect(self, retry=0):
+        pass #The worker connects when needed
+
+    def close(self):
+        pass
+
+    def reconnect(self, ipaddr=None):
+        if ipaddr is not None: self.ipaddr = ipaddr #Kept here too, a restarted worker reopens the LED controller at this address
+        self._call('reconnect', self.ipaddr)
+
+    def update_state(self, retry=2):
+        if self._deferred: return
+        self._call('update_state', retry)
+
+    def setRgbw(self, r=None, g=None, b=None, w=None, persist=True, brightness=None, retry=2, w2=None):
+        self._call('setRgbw', r, g, b, w, persist=persist, brightness=brightness, retry=retry, w2=w2)
+
+    def _change_state(self, retry, turn_on=True):
+        self._call('_change_state', retry, turn_on)
+
+    def setPresetPattern(self, pattern, speed):
+        self._call('setPresetPattern', pattern, speed)
+
+    def setRgbwOn(self, r=None, g=None, b=None, w=None, w2=None, persist=True, query=False):
+        return self._call('setRgbwOn', r, g, b, w, w2, persist=persist, query=query)
+
+    def writeQueueStats(self):
+        return self._writeQueue #As of the last reply from the worker, the writes are limited there
+
+    def reserveWrite(self, wait=True):
+        if WRITE_RATE <= 0: return True
+        return self._call('reserveWrite', wait)
+
+
+def bulbState(bulb):
+    #What a worker process returns with each reply, see RemoteConnection
+    _state = {_name: getattr(bulb, _name, None) for _name in RemoteConnection.STATE}
+    _state['_writeQueue'] = bulb.writeQueueStats()
+    _state['workerTimeouts'] = bulb.timeouts
+    _state['retryIn'] = max(bulb.retryAt - time.monotonic(), 0.)
+    return _state
+
+
+def workerMain(conn, config):
+    """
+    Entry point of a worker process: owns the ManagedBulbs of its shard of LEDs and runs each request on its
+    own thread pool, so a slow or hung LED controller only ties up one thread.
+    """
+    globals().update(config)
+    loadFluxLed()
+    _bulbs = {}
+    Watchdog(lambda: list(_bulbs.items()))
+    _sendLock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='magichome-worker')
+
+    def _handle(requestId, address, method, args, kwargs):
+        _bulb = _bulbs.get(address)
+        try:
+            if method == 'open':
+                _ipaddr, _port, _info = args
+                _bulb = _bulbs[address] = ManagedBulb(_ipaddr, _port, info=_info)
+                _reply = (requestId, True, None, bulbState(_bulb))
+            elif _bulb is None:
+                _reply = (requestId, False, ('KeyError', 'unknown LED ' + address), None)
+            else:
+                _result = getattr(_bulb, method)(*args, **kwargs)
+                _reply = (requestId, True, _result, bulbState(_bulb))
+        except Exception as ex:
+            _reply = (requestId, False, (type(ex).__name__, str(ex)), bulbState(_bulb) if _bulb is not None else None)
+        with _sendLock:
+            conn.send(_reply)
+
+    while True:
+        try:
+            _request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if _request is None: break
+        _executor.submit(_handle, *_request)
+    _executor.shutdown(wait=False)
+
+
+class WorkerPool(object):
+    """
+    WORKER_PROCESSES processes doing the network I/O of the LED controllers, each LED belonging to one of
+    them by a hash of its node address.  Requests and replies travel over a pipe per worker, a thread per
+    worker resolves the replies.  A worker that exits is restarted and its LEDs are reopened on first use.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.requests = 0
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn') #Forking a process with running threads isn't safe
+        self._workers = [None] * count #[process, connection, send lock] per worker
+        self._pending = {} #Request id -> Future
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def start(self):
+        for i in range(self.count): self._startWorker(i)
+        atexit.register(self.stop) #Before multiprocessing terminates the workers, so they aren't restarted
+        LOGGER.info('Started %i MagicHome worker processes', self.count)
+
+    def stop(self):
+        self._stopping = True
+        for _process, _conn, _sendLock in self._workers:
+            try:
+                with _sendLock:
+                    _conn.send(None)
+            except Exception:
+                pass
+        for _process, _conn, _sendLock in self._workers:
+            _process.join(2.)
+
+    def _startWorker(self, index):
+        _config = {k: globals()[k] for k in ('CONNECT_TIMEOUT', 'BACKOFF_BASE', 'BACKOFF_MAX', 'PACKET_CACHE', 'POLL_WORKERS', 'WRITE_RATE', 'WRITE_BURST', 'OP_TIMEOUT')}
+        _parent, _child = self._context.Pipe()
+        _process = self._context.Process(target=workerMain, args=(_child, _config), name='{}-{}'.format(WORKER_NAME, index), daemon=True)
+        _process.start()
+        _child.close()
+        self._workers[index] = [_process, _parent, threading.Lock()]
+        _thread = threading.Thread(target=self._receive, args=(index, _parent), name='MagicHomeWorker{}'.format(index))
+        _thread.daemon = True
+        _thread.start()
+
+    def shard(self, address):
+        return zlib.crc32(address.encode()) % self.count
+
+    def open(self, address, ipaddr, port=5577, info=None):
+        #Create the LED's ManagedBulb in its worker (probing the LED controller unless info is given) and a RemoteBulb for it here
+        _ok, _result, _state = self._request(address, 'open', (ipaddr, port, info), {})
+        self._result(_ok, _result)
+        return RemoteBulb(self, address, ipaddr, port, _state)
+
+    def call(self, bulb, method, args, kwargs):
+        _ok, _result, _state = self._request(bulb.address, method, args, kwargs)
+        if not _ok and _result[0] == 'KeyError':
+            #The worker was restarted and doesn't know this LED yet
+            self._request(bulb.address, 'open', (bulb.ipaddr, bulb.port, {n: getattr(bulb, n) for n in ('rgbwcapable', 'rgbwprotocol', 'protocol')}), {})
+            _ok, _result, _state = self._request(bulb.address, method, args, kwargs)
+        if _state is not None: bulb.applyState(_state) #Also after a failure, e.g. that the LED went offline
+        return self._result(_ok, _result), _state
+
+    def _result(self, ok, result):
+        if ok: return result
+        _type, _message = result
+        if _type in ('DeviceOffline', 'timeout', 'error', 'OSError', 'ConnectionError', 'ConnectionRefusedError', 'ConnectionResetError', 'BrokenPipeError'):
+            raise DeviceOffline(_message)
+        raise RuntimeError('{}: {}'.format(_type, _message))
+
+    def _request(self, address, method, args, kwargs):
+        _index = self.shard(address)
+        _future = Future()
+        with self._lock:
+            _id = next(self._ids)
+            self._pending[_id] = _future
+            self.requests += 1
+        _process, _conn, _sendLock = self._workers[_index]
+        try:
+            with _sendLock:
+                _conn.send((_id, address, method, args, kwargs))
+            return _future.result(timeout=POLL_TIMEOUT + CONNECT_TIMEOUT)
+        except FutureTimeout:
+            raise DeviceOffline('{} did not respond within {} sec in worker {}'.format(address, POLL_TIMEOUT + CONNECT_TIMEOUT, _index))
+        except (OSError, EOFError) as ex:
+            raise DeviceOffline('Worker {} for {} is not available: {}'.format(_index, address, str(ex)))
+        finally:
+            with self._lock:
+                self._pending.pop(_id, None)
+
+    def _receive(self, index, conn):
+        while True:
+            try:
+                _id, _ok, _result, _state = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                _future = self._pending.get(_id)
+            if _future is not None and not _future.done(): _future.set_result((_ok, _result, _state))
+        if self._stopping: return
+        LOGGER.error('MagicHome worker process %i exited, restarting it', index)
+        self.restarts += 1
+        with self._lock:
+            _orphans = [f for f in self._pending.values() if not f.done()]
+        for _future in _orphans:
+            if not _future.done(): _future.set_result((False, ('DeviceOffline', 'worker process exited'), None))
+        self._startWorker(index)
+
+
+class Watchdog(object):
+    """
+    Checks every interval seconds for a query or write to an LED controller that has been running for more than
+    OP_TIMEOUT, e.g. on a half-open connection to a controller that lost power, and abandons its connection
+    (see BulbConnection.abandon) so the stuck call fails and the threads waiting behind it get through.
+    devices returns (name, device) pairs, onTimeout(name) is called for each abandoned operation.
+    """
+    def __init__(self, devices, onTimeout=None, interval=1.0, name='MagicHomeWatchdog'):
+        self.devices = devices
+        self.onTimeout = onTimeout
+        self.interval = interval
+        self.abandoned = 0
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as ex:
+                LOGGER.error('Error checking for stuck LED controller operations: %s', str(ex))
+
+    def check(self):
+        _now = time.monotonic()
+        for _name, _device in self.devices():
+            _started = _device.opStarted
+            if _started <= 0 or _now - _started <= OP_TIMEOUT: continue
+            if not _device.abandon(_started): continue
+            self.abandoned += 1
+            LOGGER.warning('Operation on %s (%s) still running after %.1f sec, abandoning its connection', _name, _device.ipaddr, _now - _started)
+            if self.onTimeout is not None: self.onTimeout(_name)
+
+
+class DiscoveryCache(object):
+    """
+    Persists what is known about each LED controller (node address -> ip, mac, model, protocol details and
+    when it was last seen) so nodes can be rebuilt on restart without a discovery broadcast or probing
+    each controller first.  Since node addresses are derived from the MAC address, a controller that was
+    given a new IP address by DHCP is recognized and its entry updated.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self.path) as _file:
+                self.entries = json.load(_file)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as ex:
+            LOGGER.error('Error reading discovery cache %s, ignoring it: %s', self.path, str(ex))
+            self.entries = {}
+        return dict(self.entries)
+
+    def update(self, address, **info):
+        with self._lock:
+            _entry = self.entries.setdefault(address, {})
+            _entry.update(info)
+            _entry['last_seen'] = time.time()
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty: return True
+            _data = json.dumps(self.entries, indent=2, sort_keys=True)
+            self._dirty = False
+        try:
+            _tmp = self.path + '.tmp'
+            with open(_tmp, 'w') as _file:
+                _file.write(_data)
+            os.replace(_tmp, self.path) #Never leave a partially written cache behind
+        except Exception as ex:
+            LOGGER.error('Error writing discovery cache %s: %s', self.path, str(ex))
+            return False
+        return True
+
+
+class StateJournal(object):
+    """
+    Keeps the last color of each LED while on (node address -> red, green, blue, white, white2 and mode) across
+    restarts, so an on command with a level to an LED that is off scales its own color instead of full white.
+    Changes are written behind: kept in memory and appended to the file as one JSON line per LED at most
+    every STATE_JOURNAL_DELAY seconds, fsync'd at most every STATE_JOURNAL_FSYNC seconds.  The last line for
+    an address wins, the file is compacted to one line per LED once it has STATE_JOURNAL_COMPACT times more.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lines = 0 #Lines in the file
+        self.appended = 0
+        self.compactions = 0
+        self._pending = {} #Entries changed since the last flush
+        self._synced = 0. #time.monotonic() of the last fsync
+        self._lock = threading.Lock()
+
+    def load(self):
+        _entries = {}
+        _lines = 0
+        _torn = False
+        try:
+            with open(self.path) as _file:
+                for _line in _file:
+                    _torn = not _line.endswith('\n')
+                    try:
+                        _entry = json.loads(_line)
+                        _entries[_entry['a']] = _entry
+                        _lines += 1
+                    except (ValueError, KeyError, TypeError):
+                        pass #e.g. the last line cut short by a crash
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            LOGGER.error('Error reading state journal %s, ignoring it: %s', self.path, str(ex))
+        with self._lock:
+            self.entries = _entries
+            self.lines = _lines
+        if _torn or _lines > STATE_JOURNAL_COMPACT * max(len(_entries), 1): self.compact() #Appending after a cut short line would corrupt the next one
+        return dict(_entries)
+
+    def get(self, address):
+        return self.entries.get(address)
+
+    def record(self, address, color, mode):
+        #Returns True if this changed the entry, it is then appended by the next flush
+        _entry = {'a': address, 'c': [int(v) for v in color], 'm': mode}
+        with self._lock:
+            if self.entries.get(address) == _entry: return False
+            self.entries[address] = _entry
+            self._pending[address] = _entry
+        return True
+
+    def flush(self):
+        with self._lock:
+            if not self._pending: return True
+            _data = ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in self._pending.values())
+            _count = len(self._pending)
+            self._pending = {}
+            _compact = self.lines + _count > STATE_JOURNAL_COMPACT * max(len(self.entries), 1)
+        if _compact: return self.compact()
+        try:
+            with open(self.path, 'a') as _file:
+                _file.write(_data)
+                _file.flush()
+                if time.monotonic() - self._synced >= STATE_JOURNAL_FSYNC:
+                    os.fsync(_file.fileno())
+                    self._synced = time.monotonic()
+        except Exception as ex:
+            LOGGER.error('Error writing state journal %s: %s', self.path, str(ex))
+            return False
+        with self._lock:
+            self.lines += _count
+            self.appended += _count
+        return True
+
+    def compact(self):
+        with self._lock:
+            _data = ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in self.entries.values())
+            _count = len(self.entries)
+            self._pending = {} #All included
+        try:
+            _tmp = self.path + '.tmp'
+            with open(_tmp, 'w') as _file:
+                _file.write(_data)
+                _file.flush()
+                os.fsync(_file.fileno())
+            os.replace(_tmp, self.path) #Never leave a partially written journal behind
+        except Exception as ex:
+            LOGGER.error('Error compacting state journal %s: %s', self.path, str(ex))
+            return False
+        with self._lock:
+            self.lines = _count
+            self.compactions += 1
+        self._synced = time.monotonic()
+        return True
+
+
+class Scheduler(object):
+    """
+    Runs delayed jobs from a single worker thread instead of starting a threading.Timer for each one.
+    Jobs are keyed, scheduling a key that is already pending replaces the pending job rather than adding
+    another one.  This way a burst of commands to one LED pushes back a single pending status update.
+    """
+    def __init__(self, name='MagicHomeScheduler'):
+        self.scheduled = 0 #Jobs added
+        self.replaced = 0 #Jobs that replaced (pushed back) a pending job with the same key
+        self.executed = 0 #Jobs run
+        self._heap = []
+        self._jobs = {}
+        self._counter = itertools.count()
+        self._cv = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, key, delay, func, *args, reschedule=True):
+        """
+        Run func(*args) in delay seconds.  If a job with the same key is already pending it is replaced,
+        unless reschedule is False in which case the pending job is kept and False is returned.
+        """
+        with self._cv:
+            if key in self._jobs:
+                if not reschedule: return False
+                self.replaced += 1
+            else:
+                self.scheduled += 1
+            _job = [time.monotonic() + delay, next(self._counter), key, func, args]
+            self._jobs[key] = _job
+            heapq.heappush(self._heap, _job)
+            self._cv.notify()
+        return True
+
+    def cancel(self, key):
+        with self._cv:
+            return self._jobs.pop(key, None) is not None
+
+    def pending(self, key):
+        with self._cv:
+            return key in self._jobs
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while True:
+                    #Discard heap entries that were replaced or cancelled
+                    while self._heap and self._jobs.get(self._heap[0][2]) is not self._heap[0]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cv.wait()
+                        continue
+                    _wait = self._heap[0][0] - time.monotonic()
+                    if _wait <= 0: break
+                    self._cv.wait(_wait)
+                _job = heapq.heappop(self._heap)
+                del self._jobs[_job[2]]
+                self.executed += 1
+            try:
+                _job[3](*_job[4])
+            except Exception as ex:
+                LOGGER.error('Error running scheduled job %s: %s', str(_job[2]), str(ex))
+
+
+class Transitioner(object):
+    """
+    Streams fades to LED controllers at TRANSITION_FPS from a single thread.  Each frame, the colors of all
+    running fades are interpolated together and written over each LED's existing connection on the
+    controller's thread pool.  An LED whose previous frame is still being written skips the frame rather
+    than queueing it, so a slow LED controller finishes the fade late instead of falling further behind.
+    So does an LED that has no write left under its write_rate limit, only the final frame waits for one.
+    Intermediate frames are written as non-persistent colors, only the final color is saved by the LED controller.
+    """
+    def __init__(self, controller, name='MagicHomeTransitions'):
+        self.controller = controller
+        self.framesSent = 0
+        self.framesDropped = 0 #Frames skipped because the LED's previous frame hadn't been written yet, or the write rate limit
+        self.fps = 0. #Frames per second written across all LEDs during the last burst of fades
+        self._fades = {} #Node address -> running fade
+        self._busy = set() #Addresses of LEDs with a frame being written
+        self._burst = None #[start, frames sent, frames dropped, LED addresses] while fades are running
+        self._cv = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def fade(self, node, target, duration):
+        #Fade node from its current color to target (red, green, blue, white, white2) over duration seconds
+        _start = (node.red, node.green, node.blue, node.white, node.white2)
+        _fade = {'node': node, 'start': _start, 'target': tuple(int(v) for v in target), 'began': time.monotonic(),
+                 'duration': max(float(duration), 0.), 'powerOn': max(_start) <= 0 < max(target)}
+        with self._cv:
+            node._fade = _fade
+            self._fades[node.address] = _fade
+            if self._burst is None: self._burst = [time.monotonic(), 0, 0, set()]
+            self._burst[3].add(node.address)
+            self._cv.notify()
+        LOGGER.debug('Fading %s from %s to %s over %.1f sec', node.address, str(_start), str(_fade['target']), _fade['duration'])
+
+    def cancel(self, node):
+        #Stop a running fade, e.g. because another command was received for the LED
+        with self._cv:
+            _fade = self._fades.pop(node.address, None)
+            node._fade = None
+        return _fade is not None
+
+    def running(self, node):
+        with self._cv:
+            return node.address in self._fades
+
+    def _run(self):
+        _next = time.monotonic()
+        while True:
+            _frames = []
+            with self._cv:
+                while not self._fades:
+                    self._finishBurst()
+                    self._cv.wait()
+                    _next = time.monotonic()
+                _now = time.monotonic()
+                for _address, _fade in list(self._fades.items()):
+                    _progress = min((_now - _fade['began']) / _fade['duration'], 1.) if _fade['duration'] > 0 else 1.
+                    if _address in self._busy:
+                        if _progress < 1.:
+                            self.framesDropped += 1
+                            self._burst[2] += 1
+                        continue #The final frame is kept until the LED catches up
+                    if _progress >= 1.: del self._fades[_address]
+                    _color = tuple(int(round(s + (t - s) * _progress)) for s, t in zip(_fade['start'], _fade['target']))
+                    self._busy.add(_address)
+                    _frames.append((_fade, _color, _progress >= 1.))
+            for _fade, _color, _final in _frames:
+                self.controller.submit(self._writeFrame, _fade, _color, _final)
+            _next += 1. / max(TRANSITION_FPS, 1.)
+            _wait = _next - time.monotonic()
+            if _wait > 0:
+                time.sleep(_wait)
+            else:
+                _next = time.monotonic() #Running behind, don't try to catch up with a burst of frames
+
+    def _finishBurst(self):
+        if self._burst is None or self._busy: return
+        _elapsed = time.monotonic() - self._burst[0]
+        self.fps = self._burst[1] / _elapsed if _elapsed > 0 else 0.
+        LOGGER.info('Fades finished: %i frames to %i LEDs in %.2f sec (%.1f frames/sec), %i frames dropped', self._burst[1], len(self._burst[3]), _elapsed, self.fps, self._burst[2])
+        self._burst = None
+
+    def _writeFrame(self, fade, color, final):
+        node = fade['node']
+        try:
+            if node._fade is not fade: return #Cancelled or replaced since this frame was computed
+            if fade['powerOn']:
+                node.device.turnOn()
+                fade['powerOn'] = False
+            if not node.device.reserveWrite(final): #Not while holding _writeLock, a command waits for that
+                with self._cv:
+                    self.framesDropped += 1
+                    if self._burst is not None: self._burst[2] += 1
+                return
+            with node._writeLock: #Keeps a command received meanwhile from being overwritten by this frame, see MagicHomeLED.runCmd
+                if node._fade is not fade: return
+                node._writeFrame(color, final)
+            with self._cv:
+                self.framesSent += 1
+                if self._burst is not None: self._burst[1] += 1
+            if final:
+                if max(color) <= 0: node.device.turnOff()
+                node._recordWrite(*color, fade=True)
+                node._scheduleUpdate()
+        except Exception as ex:
+            LOGGER.error('Error writing fade frame to %s. %s', node.address, str(ex))
+        finally:
+            with self._cv:
+                self._busy.discard(node.address)
+                if final and node._fade is fade: node._fade = None
+                self._cv.notify() #_run waits for the last frame before finishing the burst
+
+
+class Metrics(object):
+    """
+    Latency histograms and success/failure counts per node and operation: 'query' (status query of the LED
+    controller), 'write' (coalesced color write), 'cmd_<COMMAND>' (ISY command handler) and the controller's
+    'poll' (whole poll cycle).  Buckets are cumulative-friendly so the totals can be exported to Prometheus.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.) #Upper bounds in seconds, plus an overflow bucket
+
+    def __init__(self):
+        self.lastRtt = {} #Node address -> seconds taken by the last successful status query
+        self._ops = {} #(node address, operation) -> histogram and counters
+        self._lock = threading.Lock()
+
+    def record(self, address, op, seconds, ok=True):
+        with self._lock:
+            _op = self._ops.get((address, op))
+            if _op is None:
+                _op = self._ops[(address, op)] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'count': 0, 'failures': 0, 'sum': 0., 'max': 0.}
+            _op['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            _op['count'] += 1
+            _op['sum'] += seconds
+            _op['max'] = max(_op['max'], seconds)
+            if not ok: _op['failures'] += 1
+            if ok and op == 'query': self.lastRtt[address] = seconds
+
+    def percentile(self, op, pct):
+        #Estimate from the histogram, interpolating within the bucket the percentile falls in
+        _rank = op['count'] * pct / 100.
+        _seen = 0
+        for i, _n in enumerate(op['buckets']):
+            if _n and _seen + _n >= _rank:
+                _low = self.BUCKETS[i - 1] if i > 0 else 0.
+                _high = self.BUCKETS[i] if i < len(self.BUCKETS) else op['max']
+                return min(_low + (_high - _low) * (_rank - _seen) / _n, op['max'])
+            _seen += _n
+        return 0.
+
+    def totals(self, op=None, prefix=None):
+        #Count and failures over all nodes, for one operation or all operations starting with prefix
+        with self._lock:
+            _ops = [v for (a, o), v in self._ops.items() if o == op or (prefix is not None and o.startswith(prefix))]
+            return sum(o['count'] for o in _ops), sum(o['failures'] for o in _ops)
+
+    def snapshot(self):
+        with self._lock:
+            _nodes = {}
+            for (address, op), v in sorted(self._ops.items()):
+                _node = _nodes.setdefault(address, {'ops': {}})
+                if address in self.lastRtt: _node['lastRtt'] = round(self.lastRtt[address], 6)
+                _node['ops'][op] = {'count': v['count'], 'failures': v['failures'], 'sum': round(v['sum'], 6), 'max': round(v['max'], 6),
+                                    'p50': round(self.percentile(v, 50), 6), 'p95': round(self.percentile(v, 95), 6), 'p99': round(self.percentile(v, 99), 6),
+                                    'buckets': dict(zip([str(b) for b in self.BUCKETS] + ['+Inf'], v['buckets']))}
+            return _nodes
+
+    def prometheus(self):
+        _lines = ['# HELP magichome_op_seconds Time taken by node server operations, per node and operation',
+                  '# TYPE magichome_op_seconds histogram']
+        with self._lock:
+            _ops = sorted(self._ops.items())
+            _rtt = sorted(self.lastRtt.items())
+        for (address, op), v in _ops:
+            _labels = 'node="{}",op="{}"'.format(address, op)
+            _cumulative = 0
+            for _bound, _n in zip([repr(b) for b in self.BUCKETS] + ['+Inf'], v['buckets']):
+                _cumulative += _n
+                _lines.append('magichome_op_seconds_bucket{{{},le="{}"}} {}'.format(_labels, _bound, _cumulative))
+            _lines.append('magichome_op_seconds_sum{{{}}} {:.6f}'.format(_labels, v['sum']))
+            _lines.append('magichome_op_seconds_count{{{}}} {}'.format(_labels, v['count']))
+        _lines += ['# HELP magichome_op_failures_total Failed node server operations, per node and operation',
+                   '# TYPE magichome_op_failures_total counter']
+        _lines += ['magichome_op_failures_total{{node="{}",op="{}"}} {}'.format(a, o, v['failures']) for (a, o), v in _ops]
+        _lines += ['# HELP magichome_last_rtt_seconds Duration of the last successful status query of each LED controller',
+                   '# TYPE magichome_last_rtt_seconds gauge']
+        _lines += ['magichome_last_rtt_seconds{{node="{}"}} {:.6f}'.format(a, v) for a, v in _rtt]
+        return '\n'.join(_lines) + '\n'
+
+
+class Profiler(object):
+    """
+    Opt-in profiling (PROFILE custom parameter) of the poll cycle (Controller._poll submitting the queries and
+    Controller._finishPoll waiting for them), Controller.discover, MagicHomeLED.update_info and every command handler.  Each call records its wall clock and on-CPU time (time.thread_time), which is
+    cheap enough to leave on.  A PROFILE_SAMPLE fraction of calls also runs under cProfile, one at a time.
+    Every PROFILE_INTERVAL the samples are merged and written to PROFILE_FILE and the timings to PROFILE_FILE.txt.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.installed = False
+        self._calls = {} #Function name -> [calls, wall seconds, cpu seconds, sampled calls]
+        self._samples = [] #cProfile.Profile objects not yet written
+        self._lock = threading.Lock()
+        self._sampling = threading.Lock() #Only one cProfile may be active at a time on newer Pythons
+
+    def install(self):
+        if self.installed: return
+        for _cls, _name in ((Controller, '_poll'), (Controller, '_finishPoll'), (Controller, 'discover'), (MagicHomeLED, 'update_info')):
+            setattr(_cls, _name, self.wrap(_cls.__name__ + '.' + _name, getattr(_cls, _name)))
+        for _cls in (MagicHomeLED, MagicHomeWWLED):
+            _cls.commands = {_cmd: self.wrap(_cls.__name__ + '.' + _cmd, _fun) for _cmd, _fun in _cls.commands.items()}
+        self.installed = True
+        self.controller.scheduler.schedule('profile', PROFILE_INTERVAL, self.dump)
+        LOGGER.info('Profiling enabled, sampling %.1f%% of calls, writing %s every %.0f sec', PROFILE_SAMPLE * 100., PROFILE_FILE, PROFILE_INTERVAL)
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def _profiled(*args, **kwargs):
+            _profile = None
+            if random.random() < PROFILE_SAMPLE and self._sampling.acquire(blocking=False):
+                import cProfile #Only loaded when profiling
+                _profile = cProfile.Profile()
+            _wall, _cpu = time.perf_counter(), time.thread_time()
+            try:
+                if _profile is None: return func(*args, **kwargs)
+                return _profile.runcall(func, *args, **kwargs)
+            finally:
+                _wall, _cpu = time.perf_counter() - _wall, time.thread_time() - _cpu
+                if _profile is not None: self._sampling.release()
+                with self._lock:
+                    _call = self._calls.setdefault(name, [0, 0., 0., 0])
+                    _call[0] += 1
+                    _call[1] += _wall
+                    _call[2] += _cpu
+                    if _profile is not None:
+                        _call[3] += 1
+                        self._samples.append(_profile)
+        return _profiled
+
+    def summary(self):
+        with self._lock:
+            _calls = sorted(self._calls.items(), key=lambda c: -c[1][2])
+        _lines = ['{:40} {:>8} {:>10} {:>10} {:>11} {:>11} {:>8}'.format('function', 'calls', 'wall s', 'cpu s', 'wall/call ms', 'cpu/call ms', 'sampled')]
+        for _name, (_n, _wall, _cpu, _sampled) in _calls:
+            _lines.append('{:40} {:8d} {:10.3f} {:10.3f} {:11.3f} {:11.3f} {:8d}'.format(_name, _n, _wall, _cpu, _wall / _n * 1000., _cpu / _n * 1000., _sampled))
+        return '\n'.join(_lines)
+
+    def dump(self):
+        #Merge the samples into PROFILE_FILE (accumulating across dumps) and write the wall/cpu summary next to it
+        import io, pstats
+        try:
+            with self._lock:
+                _samples, self._samples = self._samples, []
+            _summary = self.summary()
+            LOGGER.info('Profile summary:\n%s', _summary)
+            if _samples:
+                _stats = pstats.Stats(_samples[0])
+                for _sample in _samples[1:]: _stats.add(_sample)
+                if os.path.exists(PROFILE_FILE): _stats.add(PROFILE_FILE)
+                _stats.dump_stats(PROFILE_FILE + '.tmp')
+                os.replace(PROFILE_FILE + '.tmp', PROFILE_FILE)
+            _text = io.StringIO()
+            _text.write(_summary + '\n\n')
+            if os.path.exists(PROFILE_FILE):
+                pstats.Stats(PROFILE_FILE, stream=_text).sort_stats('cumulative').print_stats(40)
+            with open(PROFILE_FILE + '.txt', 'w') as _file:
+                _file.write(_text.getvalue())
+        except Exception as ex:
+            LOGGER.error('Error writing profile: %s', str(ex))
+        finally:
+            self.controller.scheduler.schedule('profile', PROFILE_INTERVAL, self.dump)
+
+
+class DiscoveryListener(object):
+    """
+    Continuous low-rate discovery (DISCOVERY_INTERVAL custom parameter).  Instead of the 5 second burst of
+    broadcasts of a full scan, a single discovery datagram is sent every DISCOVERY_INTERVAL seconds from a
+    socket that stays open, and replies are handled whenever they arrive.  When an LED stops responding an
+    early broadcast is sent, at most every DISCOVERY_MIN_GAP seconds.  Each reply is compared with the known
+    nodes by MAC address (see Controller._discovered): a node whose LED controller has a new IP address is
+    pointed at it and an LED controller without a node is probed and added, e.g. an "LED" configuration entry
+    whose IP address is out of date.
+    """
+    MESSAGE = b'HF-A11ASSISTHREAD'
+
+    def __init__(self, controller, name='MagicHomeDiscovery'):
+        self.controller = controller
+        self.name = name
+        self.sent = 0 #Broadcasts sent
+        self.replies = 0
+        self.moved = 0 #Nodes pointed at a new IP address
+        self.found = 0 #LED controllers without a node, probed to be added
+        self._socket = None
+        self._thread = None
+        self._nextSend = 0.
+        self._lastSend = 0.
+        self._requested = False
+
+    def start(self):
+        if self._thread is not None: return
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._socket.bind(('', 0)) #Not DISCOVERY_PORT, which a full scan binds to.  Replies come back to the port the broadcast was sent from.
+        self._nextSend = time.monotonic() + DISCOVERY_INTERVAL #discover() has just sent the first ones
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        LOGGER.info('Continuous discovery started, broadcasting every %.0f sec', DISCOVERY_INTERVAL)
+
+    def request(self):
+        #Ask for an early broadcast, e.g. because an LED stopped responding and may have a new IP address
+        self._requested = True
+
+    def _run(self):
+        while True:
+            try:
+                _now = time.monotonic()
+                if _now >= self._nextSend or (self._requested and _now - self._lastSend >= DISCOVERY_MIN_GAP):
+                    self._requested = False
+                    self._lastSend = _now
+                    self._nextSend = _now + DISCOVERY_INTERVAL
+                    self._socket.sendto(self.MESSAGE, (DISCOVERY_ADDRESS, DISCOVERY_PORT))
+                    self.sent += 1
+                self._socket.settimeout(min(max(self._nextSend - _now, 0.01), 1.))
+                try:
+                    _data, _addr = self._socket.recvfrom(128)
+                except socket.timeout:
+                    continue
+                _reply = _data.decode('ascii', 'replace').split(',')
+                if _data == self.MESSAGE or len(_reply) < 3: continue
+                self.replies += 1
+                _result = self.controller._discovered({'ipaddr': _reply[0], 'id': _reply[1], 'model': _reply[2]})
+                if _result == 'moved': self.moved += 1
+                elif _result == 'new': self.found += 1
+            except Exception as ex:
+                LOGGER.error('Error in continuous discovery: %s', str(ex))
+                time.sleep(1.)
+
+
+class PushListener(object):
+    """
+    Reads the persistent connections of all LED controllers for status frames they send on their own, e.g.
+    after a change from the MagicHome app or an IR remote (PUSH_LISTEN custom parameter).  A connection is
+    only read while no query or command holds it, so responses still reach the query that asked for them.
+    LEDs that push their changes are then only re-synced every PUSH_RESYNC instead of being polled.
+    """
+    def __init__(self, controller, name='MagicHomePush'):
+        self.controller = controller
+        self.name = name
+        self.framesReceived = 0
+        self._buffers = {} #Node address -> bytes received but not parsed yet
+        self._selector = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None: return
+        self._selector = selectors.DefaultSelector()
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        LOGGER.info('Listening for status changes pushed by the LED controllers')
+
+    def _run(self):
+        while True:
+            try:
+                self._watch()
+                if not self._selector.get_map():
+                    time.sleep(1.)
+                    continue
+                _busy = 0
+                _ready = self._selector.select(timeout=1.)
+                for _key, _events in _ready:
+                    if not self._read(_key.data, _key.fileobj): _busy += 1
+                if _ready and _busy == len(_ready): time.sleep(0.02) #Connections in use by queries, which read their own responses
+            except Exception as ex:
+                LOGGER.error('Error listening for pushed LED status: %s', str(ex))
+                time.sleep(1.)
+
+    def _watch(self):
+        #Keep the selector in step with the current connection of each LED, connections are replaced on reconnect
+        _wanted = {}
+        for node in list(self.controller.nodes.values()):
+            if isinstance(node, MagicHomeLED) and node.device.online and node.device._socket is not None:
+                _wanted[node.device._socket] = node
+        for _key in list(self._selector.get_map().values()):
+            if _wanted.get(_key.fileobj) is not _key.data:
+                try:
+                    self._selector.unregister(_key.fileobj)
+                except (KeyError, ValueError):
+                    pass
+        _registered = set(k.fileobj for k in self._selector.get_map().values())
+        for _socket, node in _wanted.items():
+            if _socket in _registered: continue
+            try:
+                self._selector.register(_socket, selectors.EVENT_READ, node)
+            except (KeyError, ValueError, OSError):
+                pass #Closed meanwhile
+
+    def _read(self, node, sock):
+        device = node.device
+        if not device._connLock.acquire(blocking=False): return False
+        try:
+            if device._socket is not sock or not device.online: return True
+            try:
+                sock.setblocking(0)
+                _data = sock.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                return True
+            except socket.error as ex:
+                device._markFailed(ex)
+                return True
+            finally:
+                if device._socket is sock: sock.settimeout(device.timeout)
+            if not _data:
+                device._markFailed('connection closed by LED controller')
+                node._reportDriver('GV4', 0) #Connected = False
+                return True
+        finally:
+            device._connLock.release()
+        _buffer = self._buffers.setdefault(node.address, bytearray())
+        _buffer.extend(_data)
+        for _frame in self._frames(node, _buffer):
+            self.framesReceived += 1
+            if _frame[0] == 0x0f: continue #Acknowledges one of our own commands, not a change from elsewhere
+            if _frame[0] == 0x81:
+                if not device.applyStatus(_frame): continue
+            else:
+                device._is_on = _frame[2] == 0x23
+            LOGGER.debug('%s pushed %s', node.address, _frame.hex())
+            node.onPush(_frame)
+        return True
+
+    def _frames(self, node, buffer):
+        #Split complete, checksummed frames off the buffer: 0x81 status and 0x71 power state (f0 71 from the app or a remote, 0f 71 acknowledging a command)
+        _frames = []
+        while buffer:
+            if buffer[0] == 0x81:
+                _length = node.device._query_len or 14
+            elif buffer[0] in (0xf0, 0x0f) and len(buffer) < 2:
+                break
+            elif buffer[0] in (0xf0, 0x0f) and buffer[1] == 0x71:
+                _length = 4
+            else:
+                del buffer[0] #Not the start of a frame we know, resynchronize on the next byte
+                continue
+            if len(buffer) < _length: break
+            _frame = bytes(buffer[:_length])
+            if sum(_frame[:-1]) & 0xff != _frame[-1]:
+                del buffer[0]
+                continue
+            del buffer[:_length]
+            _frames.append(_frame)
+        return _frames
+
+
+class Controller(polyinterface.Controller):
+    """
+    The Controller Class is the primary node from an ISY perspective. It is a Superclass
+    of polyinterface.Node so all methods from polyinterface.Node are available to this
+    class as well.
+
+    Class Variables:
+    self.nodes: Dictionary of nodes. Includes the Controller node. Keys are the node addresses
+    self.name: String name of the node
+    self.address: String Address of Node, must be less than 14 characters (ISY limitation)
+    self.polyConfig: Full JSON config dictionary received from Polyglot.
+    self.added: Boolean Confirmed added to ISY as primary node
+
+    Class Methods (not including the Node methods):
+    start(): Once the NodeServer config is received from Polyglot this method is automatically called.
+    addNode(polyinterface.Node): Adds Node to self.nodes and polyglot/ISY. This is called for you
+                                 on the controller itself.
+    delNode(address): Deletes a Node from the self.nodes/polyglot and ISY. Address is the Node's Address
+    longPoll(): Runs every longPoll seconds (set initially in the server.json or default 10 seconds)
+    shortPoll(): Runs every shortPoll seconds (set initially in the server.json or default 30 seconds)
+    query(): Queries and reports ALL drivers for ALL nodes to the ISY.
+    runForever(): Easy way to run forever without maxing your CPU or doing some silly 'time.sleep' nonsense
+                  this joins the underlying queue query thread and just waits for it to terminate
+                  which never happens.
+    """
+    def __init__(self, polyglot):
+        super(Controller, self).__init__(polyglot)
+        self.firstRun = True
+        self.name = 'MagicHome Controller'
+        self.executor = None
+        self.commandExecutor = None
+        self.pollLock = threading.Lock()
+        self.pollFutures = {}
+        self.lastPollDuration = 0.
+        self.scheduler = Scheduler()
+        self.transitions = Transitioner(self)
+        self.metrics = Metrics()
+        self.profiler = Profiler(self)
+        self.pushListener = PushListener(self)
+        self.discoveryListener = DiscoveryListener(self)
+        self.discoveryLock = threading.Lock()
+        self.discoveryThread = None
+        self.nodesProbing = set()
+        self.discoveryCache = None
+        self.stateJournal = None
+        self.workers = None
+        self.watchdog = Watchdog(self._watchedDevices, self._operationTimedOut)
+        self.startupPhases = [] #(phase, seconds) for the startup report
+
+    def start(self):
+        """
+        Starts in phases, each timed for the startup report: the node server is reported online to Polyglot
+        first, then the configuration and flux_led are loaded, cached LEDs added and discovery started in
+        the background.  The report is logged again once the first discovery has finished.
+        """
+        _start = time.monotonic()
+        self.startupPhases.append(('import and connect to Polyglot', _start - IMPORT_STARTED))
+        self.setDriver('ST', 1) #Report the node server online right away, LEDs are added as discovery finds them
+        _start = self._startupPhase('report online', _start)
+        LOGGER.info('Starting MagicHome LED Polyglot v2 NodeServer version {}'.format(serverVersion()))
+        self._loadConfig()
+        _start = self._startupPhase('load configuration', _start)
+        loadFluxLed()
+        _start = self._startupPhase('load flux_led', _start)
+        if WORKER_PROCESSES > 0:
+            self._startWorkers()
+            _start = self._startupPhase('start worker processes', _start)
+        self._loadStateJournal()
+        _start = self._startupPhase('load state journal', _start)
+        self._restoreCachedNodes()
+        self._addGroups()
+        _start = self._startupPhase('add cached LEDs and groups', _start)
+        self.discoverAsync()
+        if PUSH_LISTEN: self.pushListener.start()
+        if DISCOVERY_INTERVAL > 0: self.discoveryListener.start()
+        self.scheduler.schedule('stats', STATS_INTERVAL, self._reportStats)
+        self._startupPhase('start discovery', _start)
+        LOGGER.info('Startup: %s', self._startupReport())
+
+    def _startWorkers(self):
+        if PUSH_LISTEN: LOGGER.warning('push_listen is not available for LEDs handled by worker processes, they are polled')
+        self.workers = WorkerPool(WORKER_PROCESSES)
+        self.workers.start()
+
+    def _newBulb(self, address, ipaddr, port=5577, info=None):
+        #A ManagedBulb in this process, or in the worker process for the address when WORKER_PROCESSES is set
+        loadFluxLed()
+        if self.workers is not None: return self.workers.open(address, ipaddr, port, info)
+        return ManagedBulb(ipaddr, port, info=info)
+
+    def _startupPhase(self, name, start):
+        _now = time.monotonic()
+        self.startupPhases.append((name, _now - start))
+        return _now
+
+    def _startupReport(self):
+        return ', '.join('{} {:.3f} sec'.format(name, seconds) for name, seconds in self.startupPhases)
+
+    def longPoll(self):
+        if not ADAPTIVE_POLL: self._poll()
+
+    def shortPoll(self):
+        if ADAPTIVE_POLL: self._poll(dueOnly=True)
+
+    def poll(self):
+        pass
+        #for node in self.nodes:
+        #    self.nodes[node].poll()
+
+    def query(self, command=None):
+        #QUERY from the ISY: report every driver of the controller and of all LEDs, changed or not
+        self.reportDrivers()
+        return self._poll(force=True)
+
+    def _poll(self, dueOnly=False, block=False, force=False):
+        """
+        Query LED controllers in parallel so a poll cycle takes about as long as the slowest bulb rather than the sum of all of them.
+        With dueOnly, only the LEDs whose adaptive poll interval has elapsed are queried.  The queries are only submitted here,
+        the cycle is waited for on its own thread (unless block) so the ISY command queue never waits on a slow LED controller.
+        Full polls take pollLock.  dueOnly polls don't, an LED still answering its last query is skipped on its own.
+        With force, every driver of the LEDs queried is reported even if unchanged.
+        """
+        _locked = not dueOnly
+        if _locked and not self.pollLock.acquire(blocking=False):
+            LOGGER.warning('Previous poll of MagicHome LEDs still running, skipping this one')
+            return False
+        try:
+            _start = time.time()
+            _executor = self._getExecutor()
+            _futures = {}
+            _skipped = 0
+            _now = time.monotonic()
+            for address in list(self.nodes):
+                node = self.nodes[address]
+                if not isinstance(node, MagicHomeLED): continue #Controller and group nodes have no LED controller to query
+                if dueOnly and node.nextPoll > _now: continue
+                _previous = self.pollFutures.get(address)
+                if _previous is not None and not _previous.done():
+                    #Don't pile up queries behind a bulb that still hasn't answered the last one
+                    LOGGER.debug('%s is still processing the previous query, skipping', address)
+                    _skipped += 1
+                    continue
+                _future = _executor.submit(node.update_info, force)
+                self.pollFutures[address] = _future
+                _futures[_future] = node
+            if dueOnly and not _futures: return True
+            _thread = threading.Thread(target=self._finishPoll, args=(_futures, _start, _skipped, _locked), name='MagicHomePoll')
+            _thread.daemon = True
+            _thread.start()
+        except Exception as ex:
+            LOGGER.error('Error polling MagicHome LEDs: %s', str(ex))
+            if _locked: self.pollLock.release()
+            return False
+        if block: _thread.join()
+        return True
+
+    def _finishPoll(self, futures, start, skipped, locked=True):
+        #Waits for the queries of one poll cycle and reports it, pollLock (if locked) is held until then
+        try:
+            _rounds = math.ceil(len(futures) / float(POLL_WORKERS)) if futures else 1
+            _done, _pending = wait(futures, timeout=POLL_TIMEOUT * _rounds)
+            for _future in _pending:
+                LOGGER.warning('%s did not respond within %s sec during poll', futures[_future].address, str(POLL_TIMEOUT))
+                futures[_future]._reportDriver('GV4', 0) #Connected = False
+            self.lastPollDuration = time.time() - start
+            self.metrics.record(self.address, 'poll', self.lastPollDuration, not _pending)
+            LOGGER.info('Polled %i MagicHome LEDs in %.3f sec (%i timed out, %i skipped, %i workers)', len(futures), self.lastPollDuration, len(_pending), skipped, POLL_WORKERS)
+            LOGGER.debug('Scheduler totals: %i jobs scheduled, %i pushed back, %i run', self.scheduler.scheduled, self.scheduler.replaced, self.scheduler.executed)
+            _nodes = list(futures.values())
+            LOGGER.debug('Driver report totals: %i sent, %i suppressed as unchanged', sum(n.reportsSent for n in _nodes), sum(n.reportsSuppressed for n in _nodes))
+        except Exception as ex:
+            LOGGER.error('Error polling MagicHome LEDs: %s', str(ex))
+        finally:
+            if locked: self.pollLock.release()
+
+    def submit(self, func, *args):
+        return self._getExecutor().submit(func, *args)
+
+    def _reportStats(self):
+        #Update the statistics drivers and write STATS_FILE, then run again in STATS_INTERVAL
+        try:
+            _leds = [n for n in list(self.nodes.values()) if isinstance(n, MagicHomeLED)]
+            _cmds, _cmdFailures = self.metrics.totals(prefix='cmd_')
+            _queries, _queryFailures = self.metrics.totals('query')
+            self.setDriver('GV1', round(self.lastPollDuration, 2))
+            self.setDriver('GV2', sum(1 for n in _leds if n.device.online))
+            self.setDriver('GV3', _cmdFailures)
+            self.setDriver('GV6', _queryFailures)
+            if STATS_FILE:
+                _queues = {n.address: n.device.writeQueueStats() for n in _leds}
+                _queues = {a: q for a, q in _queues.items() if q is not None}
+                if STATS_FILE.endswith('.prom'):
+                    _text = self.metrics.prometheus() + self._writeQueuePrometheus(_queues)
+                else:
+                    _stats = {'time': time.time(), 'version': serverVersion(), 'startup': self.startupPhases, 'lastPollDuration': self.lastPollDuration,
+                              'discovery': {'sent': self.discoveryListener.sent, 'replies': self.discoveryListener.replies, 'moved': self.discoveryListener.moved, 'found': self.discoveryListener.found},
+                              'commands': _cmds, 'commandFailures': _cmdFailures, 'queries': _queries, 'queryFailures': _queryFailures,
+                              'nodes': self.metrics.snapshot()}
+                    for _address, _queue in _queues.items():
+                        _stats['nodes'].setdefault(_address, {'ops': {}})['writeQueue'] = _queue
+                    for _address, _node in _stats['nodes'].items():
+                        if _address in self.nodes: _node['name'] = self.nodes[_address].name
+                    _text = json.dumps(_stats, indent=1)
+                _tmp = STATS_FILE + '.tmp'
+                with open(_tmp, 'w') as _file:
+                    _file.write(_text)
+                os.replace(_tmp, STATS_FILE)
+        except Exception as ex:
+            LOGGER.error('Error reporting statistics: %s', str(ex))
+        finally:
+            self.scheduler.schedule('stats', STATS_INTERVAL, self._reportStats)
+
+    def _writeQueuePrometheus(self, queues):
+        if not queues: return ''
+        _lines = []
+        for _name, _key, _type, _help in (('write_queue_depth', 'depth', 'gauge', 'Writes waiting for the rate limit of each LED controller'),
+                                          ('write_queue_max_depth', 'maxDepth', 'gauge', 'Most writes waiting at once for each LED controller'),
+                                          ('writes_waited_total', 'waited', 'counter', 'Writes that waited for the rate limit'),
+                                          ('write_wait_seconds_total', 'waitTime', 'counter', 'Time writes spent waiting for the rate limit'),
+                                          ('writes_superseded_total', 'superseded', 'counter', 'Color writes dropped for a newer color while waiting')):
+            _lines += ['# HELP magichome_{} {}'.format(_name, _help), '# TYPE magichome_{} {}'.format(_name, _type)]
+            _lines += ['magichome_{}{{node="{}"}} {}'.format(_name, a, q[_key]) for a, q in sorted(queues.items())]
+        return '\n'.join(_lines) + '\n'
+
+    def _getExecutor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='magichome')
+        return self.executor
+
+    def submitCommand(self, func, *args):
+        #Run a command on the command thread pool, which polls and discovery don't use
+        if self.commandExecutor is None:
+            self.commandExecutor = ThreadPoolExecutor(max_workers=COMMAND_WORKERS, thread_name_prefix='magichome-cmd')
+        return self.commandExecutor.submit(func, *args)
+
+    def update_info(self):
+        pass #Nothing to update for controller
+
+    def discover(self, *args, **kwargs):
+        """
+        Probes the LED controllers listed in the configuration and those found by a discovery broadcast.
+        Probes run in parallel on the thread pool and each LED is added as soon as its probe completes.
+        Blocks until discovery is finished, use discoverAsync to run it in the background.
+        """
+        _success = False
+        _start = time.time()
+        _probes = []
+        try:
+            _items = 0
+            self.discoveryTries = 0
+            _params = self.polyConfig['customParams']
+            for key,value in _params.items():
+                _key = key.lower()
+                if _key.startswith('led'):
+                    _items += 1
+                    try:
+                        if 'ip' in value and 'mac' in value:
+                            _value = json.loads(value)
+                            _ip = _value['ip']
+                            _mac = _value['mac'].lower().replace(':','')
+                            d = {'ipaddr': _ip, 'id': _mac}
+                            _probes.append(self.submit(self._addNode, d)) #Probed while the discovery broadcast below is running
+                    except Exception as ex:
+                        LOGGER.error('Error adding node from Polyglot configuration (%s): %s', str(value), str(ex))
+            if _items == 0:
+                LOGGER.info('NOTE: LED Controllers can be specified for addition even if not detected via discovery.  Add a custom configuration parameter to Polyglot for each LED controller with a key starting with "LED".  The value should be in the following format, note the use of double quotes: {"ip":"192.168.0.84", "mac":"F0FEAF241937"}  "mac" is the MAC address without colons.')
+        except Exception as ex:
+            LOGGER.error('Error processing custom node addition from Polyglot configuration: %s', str(ex))
+
+        try:
+            LOGGER.info('Discovering MagicHome LED Controllers...')
+            _scanner = loadFluxLed().BulbScanner()
+            _scanner.scan(timeout=5)
+            _devices = _scanner.getBulbInfo()
+            LOGGER.info('%i bulbs found. Checking status and adding to ISY', len(_devices))
+            for d in _devices:
+                _probes.append(self.submit(self._addNode, d, True)) #The broadcast reports where each controller is now, follow it if the IP address changed
+            _success = True
+        except Exception as ex:
+            LOGGER.error('Error running magichome discovery (%s)', str(ex))
+
+        wait(_probes)
+        _added = sum(1 for _probe in _probes if _probe.result())
+        LOGGER.info('Discovery finished in %.1f sec, %i new MagicHome LED(s) added', time.time() - _start, _added)
+        if self.startupPhases and not any(name == 'first discovery' for name, seconds in self.startupPhases):
+            self.startupPhases.append(('first discovery', time.time() - _start))
+            LOGGER.info('Startup: %s', self._startupReport())
+        self.firstRun = False
+        return _success
+
+    def _discovered(self, d):
+        #A reply to continuous discovery, see DiscoveryListener.  Only LED controllers that are new or have moved are probed.
+        address = str(d['id']).lower()[-14:]
+        node = self.nodes.get(address)
+        if isinstance(node, MagicHomeLED) and node.device.ipaddr == d['ipaddr']: return 'known'
+        self.submit(self._addNode, d, True)
+        return 'moved' if node is not None else 'new'
+
+    def discoverAsync(self, command=None):
+        #Runs discovery in the background so neither startup nor the ISY command queue waits on it
+        with self.discoveryLock:
+            if self.discoveryThread is not None and self.discoveryThread.is_alive():
+                LOGGER.info('MagicHome LED discovery is already running')
+                return False
+            self.discoveryThread = threading.Thread(target=self.discover, name='MagicHomeDiscovery')
+            self.discoveryThread.daemon = True
+            self.discoveryThread.start()
+        return True
+
+    def _param(self, key, convert, default):
+        #A custom parameter from the Polyglot configuration passed through convert, default if it is not set or not valid
+        try:
+            _params = self.polyConfig['customParams']
+            if key in _params: return convert(_params[key])
+        except Exception as ex:
+            LOGGER.error('Error obtaining %s value from Polyglot configuration: %s', key, str(ex))
+        return default
+
+    def _boolParam(self, key, default):
+        return self._param(key, lambda v: str(v).strip().lower() in ('true', '1', 'yes', 'on'), default)
+
+    def _floatParam(self, key, default, low=None, high=None):
+        _value = self._param(key, float, default)
+        if low is not None: _value = max(_value, low)
+        if high is not None: _value = min(_value, high)
+        return _value
+
+    def _intParam(self, key, default, low=None):
+        _value = self._param(key, int, default)
+        return _value if low is None else max(_value, low)
+
+    def _strParam(self, key, default):
+        return self._param(key, lambda v: str(v).strip(), default)
+
+    def _loadConfig(self):
+        global UPDATE_DELAY, QUERY_BEFORE_CMD, STATE_MAX_AGE, POLL_WORKERS, POLL_TIMEOUT, COMMAND_WORKERS, OP_TIMEOUT, CONNECT_TIMEOUT, BACKOFF_MAX
+        global COALESCE_WINDOW, WRITE_RATE, WRITE_BURST, PIPELINE_QUERY, TRANSITION_FPS, PACKET_CACHE, STATS_FILE, STATS_INTERVAL
+        global PUSH_LISTEN, PUSH_RESYNC, WORKER_PROCESSES, PROFILE, PROFILE_SAMPLE, PROFILE_INTERVAL, PROFILE_FILE
+        global DISCOVERY_CACHE_FILE, DISCOVERY_INTERVAL, DISCOVERY_ADDRESS, STATE_JOURNAL_FILE
+        global ADAPTIVE_POLL, POLL_MIN, POLL_MAX, POLL_OFFLINE_MAX
+        if 'delay' not in self.polyConfig.get('customParams', {}):
+            LOGGER.info("NOTE: A delay can be specified to wait a bit for the LED controller to process commands before querying them to update the controller's state in the ISY.  Defaults to %s sec.", str(UPDATE_DELAY))
+        UPDATE_DELAY = self._floatParam('delay', UPDATE_DELAY)
+
+        QUERY_BEFORE_CMD = self._boolParam('query_before_cmd', QUERY_BEFORE_CMD)
+        STATE_MAX_AGE = self._floatParam('state_max_age', STATE_MAX_AGE)
+
+        POLL_WORKERS = self._intParam('poll_workers', POLL_WORKERS, 1)
+        POLL_TIMEOUT = self._floatParam('poll_timeout', POLL_TIMEOUT)
+        COMMAND_WORKERS = self._intParam('command_workers', COMMAND_WORKERS, 1)
+        OP_TIMEOUT = self._floatParam('op_timeout', OP_TIMEOUT, 1.)
+        CONNECT_TIMEOUT = self._floatParam('connect_timeout', CONNECT_TIMEOUT)
+        BACKOFF_MAX = self._floatParam('backoff_max', BACKOFF_MAX)
+
+        COALESCE_WINDOW = self._floatParam('coalesce_window', COALESCE_WINDOW)
+        WRITE_RATE = self._floatParam('write_rate', WRITE_RATE, 0.)
+        WRITE_BURST = self._intParam('write_burst', WRITE_BURST, 1)
+        PIPELINE_QUERY = self._boolParam('pipeline_query', PIPELINE_QUERY)
+        TRANSITION_FPS = self._floatParam('transition_fps', TRANSITION_FPS, 1., 100.)
+        PACKET_CACHE = self._boolParam('packet_cache', PACKET_CACHE)
+
+        STATS_FILE = self._strParam('stats_file', STATS_FILE)
+        STATS_INTERVAL = self._floatParam('stats_interval', STATS_INTERVAL, 1.)
+
+        PUSH_LISTEN = self._boolParam('push_listen', PUSH_LISTEN)
+        PUSH_RESYNC = self._floatParam('push_resync', PUSH_RESYNC)
+        WORKER_PROCESSES = self._intParam('worker_processes', WORKER_PROCESSES, 0)
+
+        PROFILE = self._boolParam('profile', PROFILE)
+        PROFILE_SAMPLE = self._floatParam('profile_sample', PROFILE_SAMPLE, 0., 1.)
+        PROFILE_INTERVAL = self._floatParam('profile_interval', PROFILE_INTERVAL, 1.)
+        PROFILE_FILE = self._strParam('profile_file', PROFILE_FILE) or PROFILE_FILE
+        try:
+            if PROFILE: self.profiler.install()
+        except Exception as ex:
+            LOGGER.error('Error starting the profiler: %s',str(ex))
+
+        DISCOVERY_CACHE_FILE = self._strParam('discovery_cache', DISCOVERY_CACHE_FILE)
+        DISCOVERY_INTERVAL = self._floatParam('discovery_interval', DISCOVERY_INTERVAL, 0.)
+        DISCOVERY_ADDRESS = self._strParam('discovery_address', DISCOVERY_ADDRESS) or '<broadcast>'
+        STATE_JOURNAL_FILE = self._strParam('state_journal', STATE_JOURNAL_FILE)
+
+        ADAPTIVE_POLL = self._boolParam('adaptive_poll', ADAPTIVE_POLL)
+        POLL_MIN = self._floatParam('poll_min', POLL_MIN)
+        POLL_MAX = self._floatParam('poll_max', POLL_MAX)
+        POLL_OFFLINE_MAX = self._floatParam('poll_offline_max', POLL_OFFLINE_MAX)
+
+    def _restoreCachedNodes(self):
+        #Add the LEDs found on previous runs without contacting them, each node revalidates itself in the background once added
+        if not DISCOVERY_CACHE_FILE: return
+        _start = time.time()
+        self.discoveryCache = DiscoveryCache(DISCOVERY_CACHE_FILE)
+        _restored = 0
+        for address, info in self.discoveryCache.load().items():
+            if address in self.nodes: continue
+            try:
+                name = 'mh ' + info['ip'].replace('.',' ')
+                led = self._newBulb(address, info['ip'], info=info)
+                self.addNode(MagicHomeLED(self, self.address, address, name, device = led))
+                _restored += 1
+            except Exception as ex:
+                LOGGER.error('Error restoring %s from discovery cache: %s', address, str(ex))
+        LOGGER.info('Restored %i MagicHome LED(s) from discovery cache in %.3f sec', _restored, time.time() - _start)
+
+    def _watchedDevices(self):
+        return [(n.address, n.device) for n in list(self.nodes.values()) if isinstance(n, MagicHomeLED)]
+
+    def _operationTimedOut(self, address):
+        #Called by the Watchdog, the LED controller is reported disconnected until a query succeeds again
+        node = self.nodes.get(address)
+        if node is None: return
+        self.metrics.record(address, 'timeout', OP_TIMEOUT, False)
+        node._reportDriver('GV4', 0) #Connected = False
+        node._scheduleUpdate(BACKOFF_BASE)
+
+    def _loadStateJournal(self):
+        if not STATE_JOURNAL_FILE: return
+        self.stateJournal = StateJournal(STATE_JOURNAL_FILE)
+        LOGGER.info('Loaded the last colors of %i MagicHome LED(s) from state journal', len(self.stateJournal.load()))
+        atexit.register(self.stateJournal.flush) #Changes still waiting to be written
+
+    def _journalState(self, node, mode):
+        #Called when an LED's last color while on changes, see StateJournal
+        if self.stateJournal is None: return
+        if self.stateJournal.record(node.address, (node.last_red, node.last_green, node.last_blue, node.last_white, node.last_white2), mode):
+            self.scheduler.schedule('stateJournal', STATE_JOURNAL_DELAY, self.stateJournal.flush, reschedule=False)
+
+    def _cacheDevice(self, address, led, mac=None, model=None):
+        if self.discoveryCache is None: return
+        _info = {'ip': led.ipaddr, 'rgbwcapable': led.rgbwcapable, 'rgbwprotocol': led.rgbwprotocol, 'protocol': led.protocol}
+        if mac is not None: _info['mac'] = mac
+        if model is not None: _info['model'] = model
+        self.discoveryCache.update(address, **_info)
+        self.scheduler.schedule('discoveryCache', 30., self.discoveryCache.save, reschedule=False) #Write changes at most every 30 sec
+
+    def _deviceSeen(self, node):
+        #Called after each successful query, keeps the cache current without rewriting it on every poll
+        if self.discoveryCache is None: return
+        _entry = self.discoveryCache.entries.get(node.address, {})
+        if (_entry.get('ip') != node.device.ipaddr or _entry.get('protocol') != node.device.protocol or
+                _entry.get('rgbwcapable') != node.device.rgbwcapable or time.time() - _entry.get('last_seen', 0) > 3600):
+            self._cacheDevice(node.address, node.device)
+
+    def _repointNode(self, node, ipaddr):
+        #The LED controller with this MAC address was given a new IP address (e.g. by DHCP), point the existing node at it
+        LOGGER.info('MagicHome LED %s moved from %s to %s', node.address, node.device.ipaddr, ipaddr)
+        try:
+            node.device.reconnect(ipaddr)
+        except Exception as ex:
+            LOGGER.error('Error connecting to %s at its new address %s: %s', node.address, ipaddr, str(ex))
+        self._cacheDevice(node.address, node.device)
+        node._scheduleUpdate(0)
+
+    def _addGroups(self):
+        try:
+            _params = self.polyConfig['customParams']
+            for key,value in _params.items():
+                _key = key.lower()
+                if _key.startswith('group'):
+                    try:
+                        _value = json.loads(value)
+                        address = ''.join(c for c in _key if c.isalnum())[:14]
+                        name = _value.get('name', key)
+                        members = [str(m).lower().replace(':','')[-14:] for m in _value['members']]
+                        if address not in self.nodes:
+                            LOGGER.info('Adding MagicHome LED group %s(%s) with %i members', name, address, len(members))
+                            self.addNode(MagicHomeGroup(self, self.address, address, name, members))
+                        else:
+                            self.nodes[address].members = members
+                    except Exception as ex:
+                        LOGGER.error('Error adding group from Polyglot configuration (%s): %s', str(value), str(ex))
+        except Exception as ex:
+            LOGGER.error('Error processing groups from Polyglot configuration: %s', str(ex))
+
+    def _addNode(self, d, repoint=False):
+        name = 'mh ' + d['ipaddr'].replace('.',' ')
+        address = str(d['id']).lower()
+        address = address[-14:]
+        with self.discoveryLock:
+            _existing = self.nodes.get(address)
+            _probing = address in self.nodesProbing
+            if _existing is None and not _probing:
+                self.nodesProbing.add(address) #The same LED can be found by the broadcast and listed in the configuration, only probe it once
+        if repoint and isinstance(_existing, MagicHomeLED) and _existing.device.ipaddr != d['ipaddr']:
+            self._repointNode(_existing, d['ipaddr'])
+            return False
+        if _existing is not None or _probing:
+            LOGGER.debug('MagicHome LED with IP address "%s" and MAC address "%s" already in ISY', name, address)
+            return False
+        try:
+            led = self._newBulb(address, d['ipaddr'])
+            self._cacheDevice(address, led, mac=str(d['id']).lower(), model=d.get('model'))
+            if led.rgbwcapable:
+                LOGGER.info('Adding new MagicHome RGBW LED: %s(%s)', name, address)
+                self.addNode(MagicHomeLED(self, self.address, address, name, device = led)) #Two node types merged, both kept herein for backwards compatability BF 30Jan2020
+            else:
+                LOGGER.info('Adding new MagicHome RGB LED: %s(%s)', name, address)
+                self.addNode(MagicHomeLED(self, self.address, address, name, device = led))
+        except Exception as ex:
+            LOGGER.error('Error adding Bulb: %s', str(ex))
+            return False
+        finally:
+            with self.discoveryLock:
+                self.nodesProbing.discard(address)
+        return True
+        
+
+    id = 'controller'
+    commands = {'DISCOVER': discoverAsync}
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2}, #Built-in for polyglot v2, do not delete
+               {'driver': 'GV1', 'value': 0, 'uom': 58}, #Last poll cycle time (seconds)
+               {'driver': 'GV2', 'value': 0, 'uom': 56}, #LEDs connected
+               {'driver': 'GV3', 'value': 0, 'uom': 56}, #Failed commands since start
+               {'driver': 'GV6', 'value': 0, 'uom': 56} #Failed status queries since start
+              ]
+
+
+class ColorStore(object):
+    """
+    Color state of all LED nodes, one byte per value in a single shared array instead of eleven attributes in
+    every node's __dict__.  Each node owns a slot of FIELDS values; slots of nodes that are gone are reused.
+    """
+    FIELDS = ('red', 'green', 'blue', 'white', 'white2', 'last_red', 'last_green', 'last_blue', 'last_white', 'last_white2', 'brightness')
+
+    def __init__(self):
+        self.values = array.array('B')
+        self._free = []
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            if self._free:
+                _slot = self._free.pop()
+                _start = _slot * len(self.FIELDS)
+                self.values[_start:_start + len(self.FIELDS)] = array.array('B', bytes(len(self.FIELDS)))
+                return _slot
+            self.values.extend(bytes(len(self.FIELDS)))
+            return len(self.values) // len(self.FIELDS) - 1
+
+    def release(self, slot):
+        with self._lock:
+            self._free.append(slot)
+
+    @classmethod
+    def field(cls, name):
+        #Property reading and writing one value of the node's slot, values are clamped to 0-255
+        _offset, _width = cls.FIELDS.index(name), len(cls.FIELDS)
+        def _get(node):
+            return node.colorStore.values[node._slot * _width + _offset]
+        def _set(node, value):
+            node.colorStore.values[node._slot * _width + _offset] = min(max(int(value), 0), 255)
+        return property(_get, _set)
+
+
+class MagicHomeLED(polyinterface.Node):
+    colorStore = ColorStore() #Shared by all LED nodes
+    red, green, blue, white, white2 = (ColorStore.field(f) for f in ColorStore.FIELDS[0:5])
+    last_red, last_green, last_blue, last_white, last_white2 = (ColorStore.field(f) for f in ColorStore.FIELDS[5:10])
+    brightness = ColorStore.field('brightness')
+
+    def __init__(self, parent, primary, address, name, device):
+        super().__init__(parent, primary, address, name)
+        self._slot = self.colorStore.allocate() #All colors and the brightness start at 0
+        weakref.finalize(self, self.colorStore.release, self._slot)
+        _saved = parent.stateJournal.get(address) if getattr(parent, 'stateJournal', None) is not None else None
+        if _saved is not None:
+            try:
+                self.last_red, self.last_green, self.last_blue, self.last_white, self.last_white2 = _saved['c']
+            except Exception as ex:
+                LOGGER.error('Error restoring the last color of %s from state journal: %s', address, str(ex))
+        self.device = device
+        self._writeLock = threading.Lock()
+        self._pendingWrite = None #Latest color waiting to be written by _flushWrite
+        self.writesSent = 0
+        self.writesDropped = 0 #Writes superseded by a newer color before being sent
+        self.reportsSent = 0
+        self.reportsSuppressed = 0
+        self.stateVersion = 0 #Incremented whenever the local state changes, by a write or a query
+        self.stateWritten = 0. #time.monotonic() of the last write to the LED controller
+        self.stateQueried = 0. #time.monotonic() of the last successful query of the LED controller
+        self.pollInterval = POLL_MIN
+        self.nextPoll = 0. #time.monotonic() value when this LED is next due to be polled
+        self._lastPolledState = None
+        self._fade = None #Fade currently streamed to this LED by the controller's Transitioner
+        self.pushes = 0 #Status frames pushed by the LED controller
+        self.lastPush = 0. #time.monotonic() of the last pushed status frame, 0 if it never pushed
+
+    def start(self):
+        LOGGER.info("%s MagicHome LED ready", self.address)
+        self._scheduleUpdate(0) #Query in the background so adding many nodes doesn't hold up the command queue
+
+    def runCmd(self, command):
+        #Any command other than a query or another fade stops a running fade before the command writes to the LED controller
+        if self._fade is not None and command.get('cmd') not in ('QUERY', 'FADE_RGBW', 'FADE_COLOR', 'FADE_LEVEL'):
+            with self._writeLock:
+                self.parent.transitions.cancel(self)
+        _fun = self.commands.get(command.get('cmd'))
+        if _fun is None: return None
+        _start = time.monotonic()
+        _ok = False
+        try:
+            _ok = _fun(self, command) is not False
+            return _ok
+        finally:
+            self.parent.metrics.record(self.address, 'cmd_' + str(command.get('cmd')), time.monotonic() - _start, _ok)
+
+    def setOn(self, command=None):
+        try:
+            _value = command.get('value')
+            LOGGER.info('Received command to turn on %s (value = %s).', self.address, str(_value))
+            
+            self._ensureFresh()
+            
+            if _value is not None:
+                _value = int(_value)
+                _str_mode = self.device.mode
+                
+                if _value == 0:
+                    return self.setOff()
+                else:
+                    _red, _green, _blue, _white, _white2 = command.get('target') or self._scaleColor(_value) #A group converts its members' colors at once, see MagicHomeGroup
+                    _queried = self._writeColorOn(self._colorArgs(_red, _green, _blue, _white, _white2))
+                    self._recordWrite(_red, _green, _blue, _white, _white2)
+                    self._commandDone(_queried)
+                    return True
+            else:
+                LOGGER.debug('On command received for %s but no value supplied', self.address)
+                if max(self.red, self.green, self.blue, self.white, self.white2) <= 0: #The LED controller turns back on to its previous color
+                    self._recordWrite(self.last_red, self.last_green, self.last_blue, self.last_white, self.last_white2)
+                
+                    
+        except Exception as ex:
+            LOGGER.error('Error turning on %s (command=%s). %s', self.address, str(command), str(ex))
+        
+        try:
+            self.device.turnOn()
+        except Exception as ex:
+            LOGGER.error('Error turning on %s. %s', self.address, str(ex))
+        
+        self._scheduleUpdate()
+        
+        return True
+
+    def _scaleColor(self, value):
+        #Returns the current color (or the last color if the bulb is off) scaled to the requested brightness percentage
+        return scaleColor(self._baseColor(), value)
+
+    def _baseColor(self):
+        #The color _scaleColor scales, as a tuple
+        _existing_color = [self.red, self.green, self.blue, self.white, self.white2]
+        _max = max(_existing_color)
+        if _max <= 0: #If the bulb is already off when an on command is issued, use the previous state when the bulb was not off instead
+            LOGGER.debug('%s is off when on command received, defaulting to white', self.address)
+            _existing_color = [self.last_red, self.last_green, self.last_blue, self.last_white, self.last_white2]
+            _max = max(_existing_color)
+            if _max <= 0:
+                #maximum is still 0 (no previous state recorded).  Set _existing_color to full on white so we don't run into divide by 0 errors below
+                #this should only happen if the node server has been reset and this is the first time we're turning on a bulb AND we've specified an on level
+                _existing_color = [255,255,255,255,255]
+        return tuple(_existing_color)
+
+    def _colorArgs(self, red, green, blue, white=0, white2=0):
+        #The setRgbw arguments that write a color, None if there is nothing to write
+        if (red + green + blue) > 0:
+            if self.device.rgbwcapable:
+                LOGGER.debug('Setting %s to red=%s, green=%s, blue=%s, white=%s', self.address, str(red), str(green), str(blue), str(white))
+                return {'r': red, 'g': green, 'b': blue, 'w': white}
+            else:
+                LOGGER.debug('Setting %s to red=%s, green=%s, blue=%s', self.address, str(red), str(green), str(blue)) #21Jan2020 Added self.address
+                return {'r': red, 'g': green, 'b': blue}
+        elif white > 0 and white2 > 0:
+            return {'w': white, 'w2': white2}
+        elif white > 0 and white2 <= 0:
+            LOGGER.debug('Setting %s to warm white %s', self.address, str(white))
+            return {'w': white, 'w2': self.white2} #Only write warm white, keep cold white at its existing level (see setWW)
+        elif white <= 0 and white2 > 0:
+            LOGGER.debug('Setting %s to cold white %s', self.address, str(white2))
+            return {'w': self.white, 'w2': white2} #Only write cold white, keep warm white at its existing level (see setCW)
+        return None
+
+    def _writeColor(self, red, green, blue, white=0, white2=0):
+        _args = self._colorArgs(red, green, blue, white, white2)
+        if _args is not None: self.device.setRgbw(**_args)
+
+    def _writeColorOn(self, args):
+        """
+        Write a color (setRgbw arguments) and turn the LED on in a single write to the LED controller.  With
+        PIPELINE_QUERY the status query goes out in the same write, returns True if it was answered.
+        """
+        if args is None:
+            self.device.turnOn()
+            return False
+        _start = time.monotonic()
+        _queried = self.device.setRgbwOn(query=PIPELINE_QUERY, **args)
+        if _queried: self.parent.metrics.record(self.address, 'query', time.monotonic() - _start)
+        return _queried
+
+    def _commandDone(self, queried=False):
+        #Report the status queried along with the command, or query the LED controller once it has processed the command
+        if queried:
+            self.parent.scheduler.cancel(('update', self.address))
+            self._reportState()
+        else:
+            self._scheduleUpdate()
+
+    def _queueWrite(self, red, green, blue, white=0, white2=0):
+        """
+        Coalesce rapid color/brightness changes (e.g. dragging a slider or holding a dimmer key) into
+        a single write to the LED controller per COALESCE_WINDOW.  Only the latest target is kept, the
+        local color is updated immediately so the next BRT/DIM or SETx command builds on this target.
+        """
+        with self._writeLock:
+            if self._pendingWrite is not None:
+                self.writesDropped += 1
+            self._pendingWrite = (red, green, blue, white, white2)
+            self._recordWrite(red, green, blue, white, white2)
+        if COALESCE_WINDOW <= 0:
+            return self._flushWrite()
+        self.parent.scheduler.schedule(('write', self.address), COALESCE_WINDOW, self.parent.submit, self._flushWrite, reschedule=False)
+        return True
+
+    def _flushWrite(self):
+        with self._writeLock:
+            _target = self._pendingWrite
+            self._pendingWrite = None
+        if _target is None: return True
+        _start = time.monotonic()
+        try:
+            self._writeColor(*_target)
+            self.writesSent += 1
+            self.parent.metrics.record(self.address, 'write', time.monotonic() - _start)
+            LOGGER.debug('Sent coalesced write to %s (%i sent, %i dropped so far)', self.address, self.writesSent, self.writesDropped)
+        except Exception as ex:
+            LOGGER.error('Error writing color to %s. %s', self.address, str(ex))
+            self.parent.metrics.record(self.address, 'write', time.monotonic() - _start, False)
+            return False
+        finally:
+            self._scheduleUpdate()
+        return True
+
+    def fastOn(self, command=None):
+        LOGGER.info('Received Fast On Command for %s', self.address)
+        _cmd = {'value': 100}
+        return self.setOn(_cmd)
+
+    def setOff(self, command=None):
+        LOGGER.info('Received command to turn off %s.', self.address)
+        self._ensureFresh()
+        try:
+            self.device.turnOff()
+            self._recordWrite(0, 0, 0, 0, 0)
+            
+            self._scheduleUpdate()
+        
+        except Exception as ex:
+            LOGGER.error('Error turning off %s. %s', self.address, str(ex))
+        return True
+
+    def fastOff(self, command=None):
+        LOGGER.info('Received Fast Off Command for %s', self.address)
+        return self.setOff(0)
+
+    def setBrtDim(self, command):
+        _cmd = command.get('cmd')
+        LOGGER.info('Received %s command on %s', str(_cmd), self.address)
+        try:
+            if _cmd == 'BRT':
+                _brightness = self.brightness + 3
+            else:
+                _brightness = self.brightness - 3
+            _brightness = max(min(_brightness,100),0)
+            if _brightness == 0: 
+                return self.setOff()
+            elif self.brightness <= 0:
+                return self.setOn({'value': _brightness}) #The LED is off, the first step turns it on along with the color
+            else:
+                _red, _green, _blue, _white, _white2 = self._scaleColor(_brightness)
+                self._queueWrite(_red, _green, _blue, _white, _white2)
+        except Exception as ex:
+            LOGGER.error('Error executing %s command on %s: %s', str(_cmd), self.address, str(ex))
+            return False
+        return True
+
+    def setManual(self, command):
+        try:
+            LOGGER.info('Received manual change command for %s, %s', self.address, str(command))
+            self._ensureFresh()
+            _cmd = command.get('cmd')
+            _val = int(command.get('value'))
+            _red = _val if _cmd == 'SETR' else self.red
+            _green = _val if _cmd == 'SETG' else self.green
+            _blue = _val if _cmd == 'SETB' else self.blue
+            
+            _white = _val if _cmd == 'SETW' and self.device.rgbwcapable else self.white
+            
+            if (_red + _green + _blue) <= 0: return self.setOff() 
+
+            self._queueWrite(_red, _green, _blue, _white, self.white2)
+        except Exception as  ex: 
+            LOGGER.error('Error setting manual rgb on %s (cmd=%s, value=%s). %s', self.address, str(_cmd), str(_val), str(ex))
+            return False
+        return True        
+
+    def setRGB(self, command):
+        try:
+            self._ensureFresh()
+            _query = command.get('query')
+            _red = int(_query.get('R.uom56'))
+            _green = int(_query.get('G.uom56'))
+            _blue = int(_query.get('B.uom56'))
+            if (_red + _green + _blue) <= 0: return self.setOff()
+            LOGGER.info('Received RGB Command, updating %s to: R:%i G:%i, B:%i', self.address, _red, _green, _blue)
+            self.device.setRgb(_red, _green, _blue)
+            self._recordRgb(_red, _green, _blue)
+            #self.device.turnOn()
+            
+            self._scheduleUpdate()
+        except Exception as  ex: 
+            LOGGER.error('Error setting RGB on %s (%s). %s', self.address, str(command), str(ex))
+            return False
+        return True
+
+    def setColor(self, command):
+        try:
+            self._ensureFresh()
+            _color = int(command.get('value'))
+            LOGGER.info('Received setColor command, changing %s color to %s', self.address, COLORS[_color][0])
+            _red, _green, _blue = command.get('target') or namedColor(_color, self.brightness) #default to 100% if the brightness is 0 (light off)
+            self.device.setRgb(_red, _green, _blue)
+            self._recordRgb(_red, _green, _blue)
+            
+            self._scheduleUpdate()
+        except Exception as  ex: 
+            LOGGER.error('Error seting color on %s (command = %s): %s', self.address, str(command), str(ex))
+            return False
+        return True
+
+    def _ensureFresh(self):
+        """
+        With QUERY_BEFORE_CMD, commands used to query the LED controller before every command.  The local state
+        (what was last written or queried) is now trusted for STATE_MAX_AGE seconds and only queried when older.
+        """
+        if self.isFresh(): return
+        LOGGER.debug('State of %s is %.1f sec old, querying before command', self.address, time.monotonic() - max(self.stateWritten, self.stateQueried))
+        self.update_info()
+
+    def isFresh(self):
+        #Whether _ensureFresh would use the local state as it is
+        return not QUERY_BEFORE_CMD or time.monotonic() - max(self.stateWritten, self.stateQueried) <= STATE_MAX_AGE
+
+    def temperatureBrightness(self):
+        #Brightness (0-255) SET_TEMP writes the color temperature at, full if the LED is off
+        _brightness = min(max(self.brightness / 100. * 255.,0),255)
+        return _brightness if _brightness > 0 else 255
+
+    def _recordWrite(self, red, green, blue, white, white2, fade=False):
+        #Remember what was just written so later commands can build on it without querying the LED controller first
+        if not fade and self._fade is not None: self.parent.transitions.cancel(self) #A new command overrides a running fade
+        self.red, self.green, self.blue, self.white, self.white2 = red, green, blue, white, white2
+        self.brightness = brightnessOf(red, green, blue, white, white2)
+        if self.brightness > 0:
+            self.last_red, self.last_green, self.last_blue, self.last_white, self.last_white2 = red, green, blue, white, white2
+            self.parent._journalState(self, 'color' if red + green + blue > 0 else 'ww')
+        self.stateVersion += 1
+        self.stateWritten = time.monotonic()
+
+    def _recordRgb(self, red, green, blue):
+        #Color-only writes leave the white channels alone, except on controllers that always write all channels
+        if self.device.rgbwprotocol:
+            self._recordWrite(red, green, blue, 0, 0)
+        else:
+            self._recordWrite(red, green, blue, self.white, self.white2)
+
+    def _writeFrame(self, color, final=False):
+        #Write one frame of a fade, all channels at once.  Only the final frame is persisted by the LED controller.
+        _red, _green, _blue, _white, _white2 = color
+        if self.device.rgbwcapable:
+            self.device.setRgbw(_red, _green, _blue, _white, persist=final, w2=_white2)
+        else:
+            self.device.setRgb(_red, _green, _blue, persist=final)
+
+    def fadeRGBW(self, command):
+        try:
+            _query = command.get('query')
+            _target = tuple(int(_query.get(p + '.uom56')) for p in ('R', 'G', 'B', 'W')) + (0,)
+            _duration = float(_query.get('D.uom58'))
+            LOGGER.info('Received Fade RGBW Command, fading %s to: R:%i G:%i, B:%i, W:%i over %.1f sec', self.address, *_target[:4], _duration)
+            self.parent.transitions.fade(self, _target, _duration)
+        except Exception as ex:
+            LOGGER.error('Error fading RGBW on %s (%s). %s', self.address, str(command), str(ex))
+            return False
+        return True
+
+    def fadeColor(self, command):
+        try:
+            _query = command.get('query')
+            _color = int(_query.get('C.uom25'))
+            _duration = float(_query.get('D.uom58'))
+            LOGGER.info('Received Fade Color Command, fading %s to %s over %.1f sec', self.address, COLORS[_color][0], _duration)
+            _target = namedColor(_color, self.brightness) + (0, 0) #Keep the current brightness, 100% if the light is off
+            self.parent.transitions.fade(self, _target, _duration)
+        except Exception as ex:
+            LOGGER.error('Error fading color on %s (%s). %s', self.address, str(command), str(ex))
+            return False
+        return True
+
+    def fadeLevel(self, command):
+        #Fade the current color (or the last color if the light is off) to a brightness, 0 fades the light off
+        try:
+            _query = command.get('query')
+            _level = max(min(int(_query.get('L.uom51')), 100), 0)
+            _duration = float(_query.get('D.uom58'))
+            LOGGER.info('Received Fade Level Command, fading %s to %i%% over %.1f sec', self.address, _level, _duration)
+            _target = self._scaleColor(_level) if _level > 0 else (0, 0, 0, 0, 0)
+            self.parent.transitions.fade(self, _target, _duration)
+        except Exception as ex:
+            LOGGER.error('Error fading level on %s (%s). %s', self.address, str(command), str(ex))
+            return False
+        return True
+
+    def setPattern(self, command):
+        #Run one of the LED controller's built-in preset patterns
+        try:
+            _query = command.get('query')
+            _pattern = int(_query.get('P.uom25'))
+            _speed = max(min(int(_query.get('S.uom51')), 100), 0)
+            LOGGER.info('Received Set Pattern Command, running pattern %s on %s at speed %i', loadFluxLed().PresetPattern.valtostr(0x25 + _pattern), self.address, _speed)
+            self.parent.transitions.cancel(self)
+            self.device.setPresetPattern(0x25 + _pattern, _speed)
+            self.stateVersion += 1
+            self.stateWritten = time.monotonic()
+            self._scheduleUpdate()
+        except Exception as ex:
+            LOGGER.error('Error setting pattern on %s (%s). %s', self.address, str(command), str(ex))
+            return False
+        return True
+
+    def _reportDriver(self, driver, value, force=False):
+        #polyinterface only sends a driver to the ISY if its value changed (or with force), counted here for the statistics
+        _sent = force or any(str(d['value']) != str(value) for d in self._drivers if d['driver'] == driver)
+        if _sent: self.reportsSent += 1
+        else: self.reportsSuppressed += 1
+        self.setDriver(driver, value, force=force)
+        return _sent
+
+    def _planNextPoll(self, ok, state=None):
+        """
+        Adaptive polling: an LED whose state just changed is polled again after POLL_MIN, the interval doubles
+        each time the state is found unchanged up to POLL_MAX.  LEDs that can't be reached back off
+        exponentially up to POLL_OFFLINE_MAX.
+        """
+        if not ok:
+            self.pollInterval = min(max(self.pollInterval, POLL_MIN) * 2., POLL_OFFLINE_MAX)
+            if DISCOVERY_INTERVAL > 0: self.parent.discoveryListener.request() #It may have a new IP address
+        elif state != self._lastPolledState:
+            self.pollInterval = POLL_MIN
+        else:
+            self.pollInterval = min(self.pollInterval * 2., POLL_MAX)
+        if ok: self._lastPolledState = state
+        if ok and PUSH_LISTEN and self.lastPush > 0:
+            self.pollInterval = max(self.pollInterval, PUSH_RESYNC) #Changes are pushed, only re-sync occasionally
+        self.nextPoll = time.monotonic() + self.pollInterval
+
+    def _scheduleUpdate(self, delay=None):
+        #Query the LED controller once it has had time to process the command.  Repeated commands push back the same pending update.
+        _delay = UPDATE_DELAY if delay is None else delay
+        self.pollInterval = POLL_MIN #Something just changed, keep an eye on this LED for a while
+        self.parent.scheduler.schedule(('update', self.address), _delay, self.parent.submit, self.update_info)
+
+    def update_info(self, force=False):
+        _start = time.monotonic()
+        _version = self.stateVersion
+        try:
+            self.device.update_state() #query LED Controller
+        except DeviceOffline as ex:
+            LOGGER.debug('Not updating %s: %s', self.address, str(ex))
+            self.parent.metrics.record(self.address, 'query', time.monotonic() - _start, False)
+            self._reportDriver('GV4', 0, force) #Connected = False
+            self._planNextPoll(False)
+            return False
+        except Exception as ex:
+            LOGGER.error('Error updating device state for %s: %s', self.address, str(ex))
+            self.parent.metrics.record(self.address, 'query', time.monotonic() - _start, False)
+            self._reportDriver('GV4', 0, force) #Connected = False
+            self._planNextPoll(False)
+            return False
+        self.parent.metrics.record(self.address, 'query', time.monotonic() - _start)
+        return self._reportState(force, _version)
+
+    def _reportState(self, force=False, version=None):
+        """
+        Update the node's color and drivers from the device's last status, from a query or pushed by the LED controller.
+        version is stateVersion when the query was sent.  If a write changed the local state since (or one is waiting
+        to be coalesced), the reply may predate it and the local color is kept, the write's own update follows.
+        """
+        if version is not None and (self.stateVersion != version or self._pendingWrite is not None):
+            LOGGER.debug('%s was written while it was queried, keeping its local color', self.address)
+            self._reportDriver('GV4', 1, force) #Connected
+            self.parent._deviceSeen(self)
+            self._scheduleUpdate()
+            return True
+        try:           
+            #Update Mode:
+            _str_mode = self.device.mode
+            if _str_mode == 'off' or not self.device.is_on:
+                self._reportDriver('GV5', 0, force)
+                self.red = 0
+                self.green = 0
+                self.blue = 0
+                self.white = 0
+                self.white2 = 0
+                self.brightness = 0
+            else:
+                try:
+                    _color = self.device.getRgbww()
+                    self.red = _color[0]
+                    self.green = _color[1]
+                    self.blue = _color[2]
+                    self.white = _color[3]
+                    self.white2 = _color[4]
+                except Exception as ex:
+                        LOGGER.info('Could not get RGBWW for %s: %s', self.address, str(ex))
+                        try:
+                            _color = self.device.getRgbw()
+                            self.red = _color[0]
+                            self.green = _color[1]
+                            self.blue = _color[2]
+                            self.white = _color[3]
+                            self.white2 = 0
+                        except Exception as ex:
+                            LOGGER.info('Could not get RGBW for %s: %s', self.address, str(ex))
+                            _color = self.device.getRgb()
+                            self.red = _color[0]
+                            self.green = _color[1]
+                            self.blue = _color[2]
+                            self.white = 0
+                            self.white2 = 0
+                if _str_mode == 'color':
+                    self._reportDriver('GV5', 1, force)
+                elif _str_mode == 'ww':
+                    self.red = 0
+                    self.green = 0
+                    self.blue = 0
+                    try:
+                        self.white = self.device._rgbw[3]
+                        self.white2 = self.device.raw_state[11]
+                    except Exception as ex:
+                            LOGGER.info('Could not retrieve white LED status for %s: %s', self.address, str(ex))
+                    self._reportDriver('GV5', 2, force)
+                #The following modes are reported but only preset can be started from the node server (SET_PATTERN).
+                #TODO: custom patterns and the sunrise/sunset timer programs are set up with the MagicHome app.
+                elif _str_mode == 'custom':
+                    self._reportDriver('GV5', 3, force)
+                elif _str_mode == 'preset':
+                    self._reportDriver('GV5', 4, force)
+                elif _str_mode == 'sunrise':
+                    self._reportDriver('GV5', 5, force)
+                elif _str_mode == 'sunset':
+                    self._reportDriver('GV5', 6, force)
+                elif _str_mode == 'default':
+                    self._reportDriver('GV5', 7, force)
+                else: #unknown
+                    self._reportDriver('GV5', 8, force)
+
+                self.brightness = brightnessOf(self.red, self.green, self.blue, self.white, self.white2)
+                self.last_red = self.red
+                self.last_green = self.green
+                self.last_blue = self.blue
+                self.last_white = self.white
+                self.last_white2 = self.white2
+                if self.brightness > 0: self.parent._journalState(self, _str_mode)
+            
+            self._reportDriver('ST', self.brightness, force)
+            self._reportDriver('GV1', self.red, force)
+            self._reportDriver('GV2', self.green, force)
+            self._reportDriver('GV3', self.blue, force)
+            self._reportDriver('GV6', self.white, force)
+            self._reportDriver('GV7', self.white2, force)
+            self._reportDriver('GV4', 1, force) #Connected
+            self.parent._deviceSeen(self)
+            _state = (self.device.mode, self.device.is_on, self.red, self.green, self.blue, self.white, self.white2)
+            if _state != self._lastPolledState: self.stateVersion += 1
+            self.stateQueried = time.monotonic()
+            self._planNextPoll(True, _state)
+            
+        except Exception as ex:
+            LOGGER.error('Error updating device info for %s: %s', self.address, str(ex))
+            self._reportDriver('GV4', 0, force) #Connected = False
+            self._planNextPoll(False)
+            return False
+        return True
+
+    def onPush(self, frame):
+        #Called by the PushListener with a frame the LED controller sent on its own
+        self.pushes += 1
+        self.lastPush = time.monotonic()
+        if frame[0] == 0x81:
+            self.parent.submit(self._reportState)
+        else:
+            self._scheduleUpdate(0) #Power state only, query the colors
+    
+    def setTemperature(self, command):
+        self._ensureFresh()
+        _temp = int(command.get('value'))
+        #Check that temperature is proper and in correct range (2700K-6500K)
+        if _temp is None:
+            LOGGER.error('Received Set Temperature Command on %s but no value supplied', self.address)
+            return False
+        if (_temp < KELVIN_MIN or _temp > KELVIN_MAX): 
+            LOGGER.error('Received Set Temperature Command on %s but not within range of 2700-6500K (%i)', self.address, _temp)
+            return False
+
+        #Check that bulb brightness is proper, if it's too low, set it to 100% (255)
+        _brightness = self.temperatureBrightness()
+
+        LOGGER.info('Received Set Temperature Command, updating %s to: %iK, brightness %i', self.address, _temp, _brightness)
+        try:
+            _warm, _cold = command.get('target') or temperatureWhites(_temp, _brightness) #What device.setWhiteTemperature would write
+            self.device.setRgbw(w=_warm, w2=_cold)
+            self._recordWrite(0, 0, 0, int(_warm), int(_cold))
+            #self.SetOn()
+            
+            self._scheduleUpdate()
+        except Exception as  ex: 
+            LOGGER.error('Error setting Temperature on %s (%s). %s', self.address, str(command), str(ex))
+            return False
+        return True
+
+    def setRGBW(self, command):
+        try:
+            self._ensureFresh()
+            _query = command.get('query')
+            _red = int(_query.get('R.uom56'))
+            _green = int(_query.get('G.uom56'))
+            _blue = int(_query.get('B.uom56'))
+            _white = int(_query.get('W.uom56'))
+            if (_red + _green + _blue + _white) <= 0: return self.setOff()
+            if self.device.rgbwcapable:
+                LOGGER.info('Received RGBW Command, updating %s to: R:%i G:%i, B:%i, W:%i', self.address, _red, _green, _blue, _white)
+                _queried = self._writeColorOn({'r': _red, 'g': _green, 'b': _blue, 'w': _white})
+                self._recordWrite(_red, _green, _blue, _white, self.white2)
+                self._commandDone(_queried)
+            elif (_red + _green + _blue) <= 0:
+                self.setWW({'value': _white})
+                self.device.turnOn()
+                self._scheduleUpdate()
+            else:
+                LOGGER.info('Received RGBW Command but bulb is not RGBW capable, updating %s to: R:%i G:%i, B:%i', self.address, _red, _green, _blue)
+                _queried = self._writeColorOn({'r': _red, 'g': _green, 'b': _blue})
+                self._recordRgb(_red, _green, _blue)
+                self._commandDone(_queried)
+        except Exception as  ex: 
+            LOGGER.error('Error setting RGBW on %s (%s). %s', self.address, str(command), str(ex))
+            return False
+        return True
+    
+    def setWW(self, command):
+        try:
+            _value = command.get('value')
+            
+            self._ensureFresh()
+            
+            if _value is not None:
+                _value = int(_value)
+                if _value == 0:
+                    return self.setOff()
+                else:
+                    LOGGER.debug('Setting %s to warm white %s', self.address, str(_value))
+                    #self.device.setWarmWhite255(_value)   
+                    self.device.setRgbw(w=_value,w2=self.white2) #Default behavior in flux_led module is to write both warm white and cold white to same value if only one is written.  In order to only write one, we're setting the White2 value to the existing level so that it stays the same
+                    self._recordWrite(0, 0, 0, _value, self.white2)
+        except Exception as ex:
+            LOGGER.error('Error setting %s warm white percentage to %s. %s', self.address, str(_value), str(ex))
+        
+        self._scheduleUpdate()
+        
+        return True
+ 
+    def setCW(self, command):
+        try:
+            _value = command.get('value')
+            
+            self._ensureFresh()
+            
+            if _value is not None:
+                _value = int(_value)
+                if _value == 0:
+                    return self.setOff()
+                else:
+                    LOGGER.debug('Setting %s to cold white %s', self.address, str(_value))
+                    #self.device.setColdWhite255(_value)
+                    self.device.setRgbw(w=self.white,w2=_value) #Default behavior in flux_led module is to write both warm white and cold white to same value if only one is written.  In order to only write one, we're setting the White value to the existing level so that it stays the same
+                    self._recordWrite(0, 0, 0, self.white, _value)
+        except Exception as ex:
+            LOGGER.error('Error setting %s cold white percentage to %s. %s', self.address, str(_value), str(ex))
+        
+        self._scheduleUpdate()
+        
+        return True      
+    
+    def query(self, command=None):
+        LOGGER.debug('Querying %s', self.address)
+        self.update_info(force=True) #Explicit query from the ISY reports all drivers, even unchanged ones
+
+    def longPoll(self):
+        self.query()
+
+    def poll(self):
+        pass
+            
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 51}, #BRIGHTNESS
+               {'driver': 'GV1', 'value': 0, 'uom': 56}, #RED
+               {'driver': 'GV2', 'value': 0, 'uom': 56}, #GREEN
+               {'driver': 'GV3', 'value': 0, 'uom': 56}, #BLUE
+               {'driver': 'GV6', 'value': 0, 'uom': 56}, #WARM WHITE
+               {'driver': 'GV7', 'value': 0, 'uom': 56}, #COLD WHITE
+               {'driver': 'GV4', 'value': 0, 'uom': 2}, #Connected
+               {'driver': 'GV5', 'value': 8, 'uom': 25} #Mode (Index)
+              ]
+
+    id = 'magichomeled'
+    commands = {
+                    'DON': setOn, 
+                    'DOF': setOff, 
+                    'DFON': fastOn, 
+                    'DFOF': fastOff, 
+                    'QUERY': query,
+                    'BRT': setBrtDim, 'DIM': setBrtDim, 
+                    'SET_COLOR': setColor, 
+                    'SETR': setManual, 'SETG': setManual, 'SETB': setManual, 'SETW': setManual,
+                    'SET_RGB': setRGB,
+                    'SET_RGBW': setRGBW,
+                    'SETWW': setWW,
+                    'SETCW': setCW,
+                    'SET_TEMP': setTemperature,
+                    'FADE_RGBW': fadeRGBW,
+                    'FADE_COLOR': fadeColor,
+                    'FADE_LEVEL': fadeLevel,
+                    'SET_PATTERN': setPattern
+                }
+
+class MagicHomeWWLED(MagicHomeLED): #Provided for backward compatability
+   
+    def update_info(self, force=False):
+        super().update_info(force)
+        
+
+    def setTemperature(self, command):
+        super().setTemperature(command)
+
+    def setRGBW(self, command):
+        super().setRGBW(command)
+
+    def setOn(self, command=None):
+        super().setOn(command)
+
+    def setOff(self, command=None):
+        super().setOff(command)
+
+    def fastOn(self, command=None):
+        super().fastOn(command)
+
+    def fastOff(self, command=None):
+        super().fastOff(command)
+
+    def query(self, command=None):
+        super().query(command)
+
+    def setBrtDim(self, command=None):
+        super().setBrtDim(command)
+
+    def setColor(self, command):
+        super().setColor(command)
+
+    def setManual(self, command):
+        super().setManual(command)
+
+    def setRGB(self, command):
+        super().setRGB(command)
+    
+    def setWW(self, command):
+        super().setWW(command)
+ 
+    def setCW(self, command):
+        super().setCW(command)
+
+    def longPoll(self):
+        super().longPoll(self)
+
+    def poll(self):
+        super().poll(self)
+
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 51}, #BRIGHTNESS
+               {'driver': 'GV1', 'value': 0, 'uom': 56}, #RED
+               {'driver': 'GV2', 'value': 0, 'uom': 56}, #GREEN
+               {'driver': 'GV3', 'value': 0, 'uom': 56}, #BLUE
+               {'driver': 'GV6', 'value': 0, 'uom': 56}, #WARM WHITE
+               {'driver': 'GV7', 'value': 0, 'uom': 56}, #COLD WHITE
+               {'driver': 'GV4', 'value': 0, 'uom': 2}, #Connected
+               {'driver': 'GV5', 'value': 8, 'uom': 25} #Mode (Index)
+              ]
+
+    id = 'magichomewwled'
+    commands = {
+                    'DON': setOn, 
+                    'DOF': setOff, 
+                    'DFON': fastOn, 
+                    'DFOF': fastOff, 
+                    'QUERY': query,
+                    'BRT': setBrtDim, 'DIM': setBrtDim, 
+                    'SET_COLOR': setColor, 
+                    'SETR': setManual, 'SETG': setManual, 'SETB': setManual, 'SETW': setManual,
+                    'SET_RGB': setRGB,
+                    'SET_RGBW': setRGBW,
+                    'SETWW': setWW,
+                    'SETCW': setCW,
+                    'SET_TEMP': setTemperature,
+                    'FADE_RGBW': MagicHomeLED.fadeRGBW,
+                    'FADE_COLOR': MagicHomeLED.fadeColor,
+                    'FADE_LEVEL': MagicHomeLED.fadeLevel,
+                    'SET_PATTERN': MagicHomeLED.setPattern
+                }
+
+
+class MagicHomeGroup(polyinterface.Node):
+    """
+    A group of MagicHome LEDs, configured with a custom parameter whose key starts with "group".
+    Each command is sent to all member LEDs at the same time on the controller's command thread pool rather
+    than one after another, so the whole group changes within about one network round trip.  The command
+    returns once the member commands are submitted, GV4 is updated when the last of them has finished.  For
+    SET_COLOR, SET_TEMP and DON with a level, the members' colors are converted together first
+    (see namedColors, temperatureColors and scaleColors) and each member writes its own.
+    """
+    def __init__(self, parent, primary, address, name, members):
+        super().__init__(parent, primary, address, name)
+        self.members = members #Node addresses of the member LEDs
+        self._lock = threading.Lock()
+
+    def start(self):
+        LOGGER.info('%s MagicHome LED group ready (%i members)', self.address, len(self.members))
+
+    def fanOut(self, command):
+        _cmd = command.get('cmd')
+        _nodes = [self.parent.nodes[a] for a in self.members if isinstance(self.parent.nodes.get(a), MagicHomeLED)]
+        if len(_nodes) < len(self.members):
+            LOGGER.warning('%s: %i of %i group members not found', self.address, len(self.members) - len(_nodes), len(self.members))
+        LOGGER.info('Sending %s to %i members of %s', str(_cmd), len(_nodes), self.address)
+        _start = time.time()
+        _targets = self.memberTargets(_cmd, command, _nodes)
+        _futures = {self.parent.submitCommand(node.runCmd, dict(command, target=_targets[node.address]) if node.address in _targets else command): node
+                    for node in _nodes if _cmd in node.commands}
+        _progress = {'left': len(_futures), 'failed': []}
+        for _future in _futures:
+            _future.add_done_callback(functools.partial(self._memberDone, _cmd, _start, _futures, _progress))
+
+        if _cmd in ('DON', 'DFON'):
+            _value = command.get('value')
+            self.setDriver('ST', int(_value) if _value is not None and _cmd == 'DON' else 100)
+        elif _cmd in ('DOF', 'DFOF'):
+            self.setDriver('ST', 0)
+        if not _futures: self.setDriver('GV4', 1)
+        return True
+
+    def _memberDone(self, cmd, start, futures, progress, future):
+        #Called as each member's command finishes, reports the group's result once all have
+        _node = futures[future]
+        with self._lock:
+            if future.exception() is not None or future.result() is False: progress['failed'].append(_node.address)
+            progress['left'] -= 1
+            if progress['left'] > 0: return
+        _failed = progress['failed']
+        if _failed:
+            LOGGER.error('%s failed on %s', str(cmd), ', '.join(_failed))
+        LOGGER.debug('%s sent to %i members of %s in %.3f sec', str(cmd), len(futures), self.address, time.time() - start)
+        self.setDriver('GV4', 0 if _failed else 1)
+
+    def memberTargets(self, cmd, command, nodes):
+        """
+        The color each member writes for the command, by node address, converted for all members at once.  Members
+        whose state _ensureFresh would query first are left out and convert their own once queried.
+        """
+        _targets = {}
+        try:
+            _nodes = [n for n in nodes if n.isFresh()]
+            if not _nodes or cmd not in ('SET_COLOR', 'SET_TEMP', 'DON') or command.get('value') is None: return _targets
+            _value = int(command.get('value'))
+            if cmd == 'SET_COLOR':
+                _targets.update(zip((n.address for n in _nodes), namedColors(_value, [n.brightness for n in _nodes])))
+            elif cmd == 'SET_TEMP':
+                if _value < KELVIN_MIN or _value > KELVIN_MAX: return _targets #Each member logs the error
+                _targets.update(zip((n.address for n in _nodes), temperatureColors(_value, [n.temperatureBrightness() for n in _nodes])))
+            elif _value > 0:
+                _targets.update(zip((n.address for n in _nodes), scaleColors([n._baseColor() for n in _nodes], _value)))
+        except Exception as ex:
+            LOGGER.error('Error converting %s for members of %s, each member converts its own: %s', str(cmd), self.address, str(ex))
+            _targets.clear()
+        return _targets
+
+    def query(self, command=None):
+        self.reportDrivers()
+
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 51}, #Level last sent to the group
+               {'driver': 'GV4', 'value': 0, 'uom': 2} #All members responded to the last command
+              ]
+
+    id = 'magichomegroup'
+    commands = {
+                    'DON': fanOut,
+                    'DOF': fanOut,
+                    'DFON': fanOut,
+                    'DFOF': fanOut,
+                    'QUERY': query,
+                    'BRT': fanOut, 'DIM': fanOut,
+                    'SET_COLOR': fanOut,
+                    'SET_RGB': fanOut,
+                    'SET_RGBW': fanOut,
+                    'SETWW': fanOut,
+                    'SETCW': fanOut,
+                    'SET_TEMP': fanOut,
+                    'FADE_RGBW': fanOut,
+                    'FADE_COLOR': fanOut,
+                    'FADE_LEVEL': fanOut,
+                    'SET_PATTERN': fanOut
+                }
+
+
+if __name__ == "__main__":
+    try:
+        polyglot = polyinterface.Interface('MagicHome')
+        polyglot.start()
+        control = Controller(polyglot)
+        control.runForever()
+    except (KeyboardInterrupt, SystemExit):
+        sys.exit(0)